@@ -0,0 +1,299 @@
+import heapq
+import itertools
+from threading import Condition
+from threading import Lock
+from threading import Thread
+import time
+import wave
+
+import numpy as np
+
+from drums import BIT_DEPTH
+from drums import SAMPLE_RATE
+from voice_pool import remaining_level
+from voice_pool import VoicePool
+
+BLOCK_SIZE = 512
+RING_BUFFER_BLOCKS = 8
+LOOKAHEAD_SECONDS = 0.05
+MAX_RANGE = 2 ** (BIT_DEPTH - 1) - 1
+
+
+class NullSink:
+    """
+    Discards audio. If `realtime` is True, writes are paced like a sound card so timing behaves as it would with one
+    """
+    def __init__(self, realtime: bool = True):
+        self.realtime = realtime
+        self.frames_written = 0
+        self._start_time = None
+
+    def open(self):
+        self._start_time = time.perf_counter()
+
+    def write(self, block: np.ndarray):
+        self.frames_written += len(block)
+        if self.realtime:
+            delay = self._start_time + self.frames_written / SAMPLE_RATE - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    """
+    Streams audio to a WAV file as fast as it can be mixed
+    """
+    def __init__(self, path: str, realtime: bool = False):
+        super().__init__(realtime)
+        self.path = path
+        self._wav_file = None
+
+    def open(self):
+        super().open()
+        self._wav_file = wave.open(self.path, 'wb')
+        self._wav_file.setnchannels(1)
+        self._wav_file.setsampwidth(BIT_DEPTH // 8)
+        self._wav_file.setframerate(SAMPLE_RATE)
+
+    def write(self, block: np.ndarray):
+        self._wav_file.writeframes(block.astype('<i2').tobytes())
+        super().write(block)
+
+    def close(self):
+        self._wav_file.close()
+
+
+class SoundDeviceSink:
+    """
+    A single long-lived output stream on the default sound card. Needs the `sounddevice` package, since simpleaudio can
+    only play whole buffers
+    """
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self._stream = None
+
+    def open(self):
+        import sounddevice
+        self._stream = sounddevice.OutputStream(
+            samplerate=SAMPLE_RATE,
+            channels=1,
+            dtype='int16',
+            blocksize=self.block_size,
+        )
+        self._stream.start()
+
+    def write(self, block: np.ndarray):
+        self._stream.write(block)
+
+    def close(self):
+        self._stream.stop()
+        self._stream.close()
+
+
+class RingBuffer:
+    """
+    Fixed number of preallocated blocks passed from the mixer thread to the output thread. The writer blocks while it's
+    full, which is what keeps the mixer a bounded distance ahead of the output
+    """
+    def __init__(self, n_blocks: int, block_size: int):
+        self._blocks = np.zeros((n_blocks, block_size), dtype=np.int16)
+        self._n_written = 0
+        self._n_read = 0
+        self._condition = Condition()
+        self.underruns = 0
+
+    def __len__(self):
+        return self._n_written - self._n_read
+
+    def write(self, block: np.ndarray, timeout: float = None) -> bool:
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self) < len(self._blocks), timeout):
+                return False
+            self._blocks[self._n_written % len(self._blocks)] = block
+            self._n_written += 1
+            self._condition.notify_all()
+            return True
+
+    def read(self, out: np.ndarray, timeout: float = None) -> bool:
+        """
+        Copy the oldest block into `out`. If none arrives within `timeout`, fill `out` with silence and count an
+        underrun
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self) > 0, timeout):
+                out[:] = 0
+                self.underruns += 1
+                return False
+            out[:] = self._blocks[self._n_read % len(self._blocks)]
+            self._n_read += 1
+            self._condition.notify_all()
+            return True
+
+
+class Voice:
+    def __init__(self, sample: np.ndarray, start_frame: int, owner=None, choke_group=None):
+        self.sample = sample
+        self.start_frame = start_frame
+        self.owner = owner
+        self.choke_group = choke_group
+        self.position = 0
+
+    @property
+    def is_finished(self):
+        return self.position >= len(self.sample)
+
+    def is_playing(self) -> bool:
+        return not self.is_finished
+
+    def level(self) -> int:
+        return remaining_level(self.sample, self.position)
+
+    def stop(self):
+        self.position = len(self.sample)
+
+
+class AudioEngine:
+    """
+    Mixes scheduled hits into fixed-size blocks for one long-lived output stream.
+
+    Hits are scheduled at absolute frame positions with `schedule`. The mixer thread sums the active voices into blocks
+    and queues them in a ring buffer, and the output thread feeds that to the sink. Callers should schedule at least
+    `lookahead_frames` ahead of `frame` so hits land exactly; hits scheduled too late play at the start of the next
+    block and are counted in `late_hits`. Voices are limited by a `VoicePool`, which stops some as others start.
+
+    A loop (e.g. a `sequencer.LoopBuffer`) can also be played with `play_loop`, which repeats it from a given frame
+    at a fixed cost per block, however many hits it contains
+    """
+    def __init__(
+        self,
+        sink=None,
+        block_size: int = BLOCK_SIZE,
+        ring_buffer_blocks: int = RING_BUFFER_BLOCKS,
+        lookahead_seconds: float = LOOKAHEAD_SECONDS,
+        voice_pool: VoicePool = None,
+    ):
+        self.sink = sink if sink is not None else NullSink()
+        self.voice_pool = voice_pool if voice_pool is not None else VoicePool()
+        self.block_size = block_size
+        # The mixer can get a whole ring buffer ahead at once, e.g. when it starts, so the lookahead is on top of that
+        self.lookahead_frames = int(lookahead_seconds * SAMPLE_RATE) + ring_buffer_blocks * block_size
+        self.ring_buffer = RingBuffer(ring_buffer_blocks, block_size)
+
+        self.frame = 0
+        self.late_hits = 0
+        self.running = False
+
+        self._pending = []
+        self._pending_lock = Lock()
+        self._sequence_numbers = itertools.count()
+        self._voices = []
+        # (loop, start frame) as one attribute, so the mixer thread never sees a loop with another loop's start
+        self._loop = None
+        self._mix_buffer = np.zeros(block_size, dtype=np.int32)
+        self._threads = []
+
+    def __repr__(self):
+        return f'AudioEngine {self.stats()}'
+
+    @property
+    def block_duration(self):
+        return self.block_size / SAMPLE_RATE
+
+    def schedule(self, sample: np.ndarray, frame: int, owner=None, choke_group=None) -> None:
+        """
+        `owner` (e.g. the drum playing `sample`) and `choke_group` are used to limit voices, see `VoicePool`
+        """
+        with self._pending_lock:
+            heapq.heappush(self._pending, (frame, next(self._sequence_numbers), sample, owner, choke_group))
+
+    def play_loop(self, loop, start_frame: int) -> None:
+        """
+        Repeat `loop` from `start_frame` until stopped, replacing any loop already playing. `loop` needs a method
+        `add_into(out, position)` that adds the audio `position` frames after its start into `out`
+        """
+        self._loop = (loop, start_frame)
+
+    def stop_loop(self) -> None:
+        self._loop = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.sink.open()
+        self._threads = [Thread(target=self._run_mixer, daemon=True), Thread(target=self._run_output, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for thread in self._threads:
+            thread.join()
+        self.sink.close()
+
+    def stats(self) -> dict:
+        return {
+            'frame': self.frame,
+            'active_voices': len(self._voices),
+            'stolen_voices': self.voice_pool.n_stolen,
+            'choked_voices': self.voice_pool.n_choked,
+            'pending_hits': len(self._pending),
+            'late_hits': self.late_hits,
+            'underruns': self.ring_buffer.underruns,
+        }
+
+    def mix_block(self) -> np.ndarray:
+        """
+        Mix the next block of audio and advance `frame`
+        """
+        block_start = self.frame
+        block_end = block_start + self.block_size
+
+        with self._pending_lock:
+            while self._pending and self._pending[0][0] < block_end:
+                start_frame, _, sample, owner, choke_group = heapq.heappop(self._pending)
+                if start_frame < block_start:
+                    self.late_hits += 1
+                    start_frame = block_start
+                voice = Voice(sample, start_frame, owner, choke_group)
+                # Any voices this stops mix nothing more, and are dropped below
+                self.voice_pool.add(voice)
+                self._voices.append(voice)
+
+        mix = self._mix_buffer
+        mix[:] = 0
+        for voice in self._voices:
+            offset = max(voice.start_frame - block_start, 0)
+            n_frames = min(self.block_size - offset, len(voice.sample) - voice.position)
+            mix[offset:offset + n_frames] += voice.sample[voice.position:voice.position + n_frames]
+            voice.position += n_frames
+        self._voices = [voice for voice in self._voices if not voice.is_finished]
+
+        playing_loop = self._loop
+        if playing_loop is not None and playing_loop[1] < block_end:
+            loop, loop_start_frame = playing_loop
+            offset = max(loop_start_frame - block_start, 0)
+            loop.add_into(mix[offset:], block_start + offset - loop_start_frame)
+
+        self.frame = block_end
+        return np.clip(mix, -MAX_RANGE - 1, MAX_RANGE).astype(np.int16)
+
+    def _run_mixer(self):
+        block = None
+        while self.running:
+            if block is None:
+                block = self.mix_block()
+            # Time out now and then to notice being stopped
+            if self.ring_buffer.write(block, timeout=self.block_duration):
+                block = None
+
+    def _run_output(self):
+        block = np.zeros(self.block_size, dtype=np.int16)
+        while self.running:
+            self.ring_buffer.read(block, timeout=self.block_duration)
+            self.sink.write(block)
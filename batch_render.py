@@ -0,0 +1,166 @@
+"""
+Render a library of patterns offline, spread across a pool of worker processes.
+
+The manifest is JSON (or YAML, if PyYAML is installed) of this form:
+
+    {
+        "defaults": {"bpm": 120, "pulses_per_beat": 4, "n_bars": 4, "format": "wav", "loop": true},
+        "kits": {
+            "tight": {"BassDrum": {"AMP_DECAY": 0.2}, "SnareDrum": {}, "HighHat": {"DECAY": 0.02}}
+        },
+        "jobs": [
+            {
+                "name": "backbeat",
+                "kit": "tight",
+                "bpm": 110,
+                "pattern": {
+                    "BassDrum": {"indices": [0, 8], "length": 16},
+                    "SnareDrum": {"indices": [4, 12], "length": 16},
+                    "HighHat": [1, 1, 1, 0]
+                }
+            }
+        ]
+    }
+
+A job's kit is either the name of a kit or a kit given inline. Each lane of a pattern is a list of steps, or the
+arguments to `true_at_indices`. Outputs are written to `<output dir>/<name>.wav` or `.npy`.
+
+No audio backend or GUI toolkit is needed. Each worker process keeps its own sample cache, so a drum shared between
+jobs is only synthesised once per worker. With `--cache-dir`, samples are also kept on disk, so they're synthesised
+once across all workers and later runs.
+"""
+import argparse
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from drums import BassDrum
+from drums import DiskSampleCache
+from drums import Drum
+from drums import HighHat
+from drums import SAMPLE_RATE
+from drums import SnareDrum
+from drums import write_wav
+from sequencer import BEATS_PER_BAR
+from sequencer import calculate_pulse_duration
+from sequencer import render_pattern
+from sequencer import true_at_indices
+
+DRUM_CLASSES = {drum_class.__name__: drum_class for drum_class in (BassDrum, SnareDrum, HighHat)}
+JOB_DEFAULTS = {
+    'bpm': 120,
+    'pulses_per_beat': 4,
+    'n_bars': 4,
+    'format': 'wav',
+    'loop': True,
+}
+OUTPUT_FORMATS = ['wav', 'npy']
+
+
+def load_manifest(path: str) -> dict:
+    with open(path) as manifest_file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(manifest_file)
+        return json.load(manifest_file)
+
+
+def expand_jobs(manifest: dict) -> list:
+    """
+    Fill in each job's defaults and resolve its kit, so that jobs are self-contained and can be sent to workers
+    """
+    defaults = {**JOB_DEFAULTS, **manifest.get('defaults', {})}
+    kits = manifest.get('kits', {})
+    jobs = []
+    for index, job in enumerate(manifest['jobs']):
+        job = {**defaults, 'name': f'job_{index}', **job}
+        kit = job.get('kit', {})
+        job['kit'] = kits[kit] if isinstance(kit, str) else kit
+        if job['format'] not in OUTPUT_FORMATS:
+            raise ValueError(f'Job {job["name"]} has format {job["format"]}, must be one of {OUTPUT_FORMATS}')
+        unrecognised_drums = set(job['pattern']) - set(DRUM_CLASSES)
+        if unrecognised_drums:
+            raise ValueError(f'Job {job["name"]} has unrecognised drums: {unrecognised_drums}')
+        jobs.append(job)
+    return jobs
+
+
+def _lane_steps(lane) -> list:
+    if isinstance(lane, dict):
+        return true_at_indices(**lane)
+    return [bool(step) for step in lane]
+
+
+def render_job(job: dict, output_dir: str) -> dict:
+    """
+    Render one job and write it out. Runs in a worker process
+    """
+    start_time = time.perf_counter()
+    lanes = {
+        DRUM_CLASSES[drum_name](**job['kit'].get(drum_name, {})): _lane_steps(lane)
+        for drum_name, lane in job['pattern'].items()
+    }
+    n_pulses = int(job['n_bars']) * BEATS_PER_BAR * int(job['pulses_per_beat'])
+    pulse_duration = calculate_pulse_duration(job['bpm'], job['pulses_per_beat'])
+    audio = render_pattern(lanes, pulse_duration, n_pulses, loop=job['loop'])
+
+    path = os.path.join(output_dir, f'{job["name"]}.{job["format"]}')
+    if job['format'] == 'wav':
+        write_wav(path, audio)
+    else:
+        np.save(path, audio)
+
+    return {
+        'name': job['name'],
+        'path': path,
+        'audio_seconds': len(audio) / SAMPLE_RATE,
+        'render_seconds': time.perf_counter() - start_time,
+        'worker': os.getpid(),
+    }
+
+
+def _init_worker(cache_dir):
+    if cache_dir:
+        Drum.disk_cache = DiskSampleCache(cache_dir)
+
+
+def render_all(jobs: list, output_dir: str, max_workers: int = None, cache_dir: str = None) -> list:
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(cache_dir,)) as executor:
+        futures = [executor.submit(render_job, job, output_dir) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(
+                f'[{len(results)}/{len(jobs)}] {result["name"]} ({result["render_seconds"]:.2f} s)',
+                file=sys.stderr,
+            )
+
+    wall_seconds = time.perf_counter() - start_time
+    audio_seconds = sum(result['audio_seconds'] for result in results)
+    n_workers = len({result['worker'] for result in results})
+    print(
+        f'Rendered {len(results)} jobs, {audio_seconds:.1f} s of audio, '
+        f'in {wall_seconds:.2f} s on {n_workers} workers: '
+        f'{len(results) / wall_seconds:.1f} jobs/s, {audio_seconds / wall_seconds:.0f}x real time',
+        file=sys.stderr,
+    )
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='JSON or YAML manifest of pattern jobs')
+    parser.add_argument('--output-dir', default='renders', help='directory to write rendered patterns to')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per core)')
+    parser.add_argument('--cache-dir', help='directory to keep synthesised samples in, shared between runs')
+    args = parser.parse_args()
+
+    render_all(expand_jobs(load_manifest(args.manifest)), args.output_dir, args.workers, args.cache_dir)
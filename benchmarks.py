@@ -0,0 +1,360 @@
+"""
+Benchmarks for drum synthesis, reverb, pulse scheduling, the shared engine, GUI/sequencer event transport and startup
+time.
+
+Runs headless: simpleaudio and tkinter are replaced with mocks before anything else is imported, and drums don't
+actually play. Results are written as JSON so runs on different commits can be compared:
+
+    python benchmarks.py --output before.json
+    (change something)
+    python benchmarks.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from threading import Event as ThreadingEvent
+from unittest import mock
+
+sys.modules.setdefault('simpleaudio', mock.MagicMock())
+sys.modules.setdefault('tkinter', mock.MagicMock())
+
+import numpy as np
+
+import drums
+from drums import BassDrum
+from drums import HighHat
+from drums import SnareDrum
+from sequencer import Sequencer
+from sequencer import true_at_indices
+from sequencer_gui_interface import GUIEvent
+from sequencer_gui_interface import ListenerThread
+from sequencer_gui_interface import SequencerEvent
+from sequencer_gui_interface import SequencerGUIInterface
+from shared_engine import SharedEngine
+
+SYNTHESIS_PARAMETER_SETS = {
+    BassDrum: {
+        'default': {},
+        'short': {'AMP_DECAY': 0.05, 'FREQ_DECAY': 0.05},
+        'long': {'AMP_DECAY': 1, 'FREQ_DECAY': 0.8, 'MAX_PITCH': 2000},
+    },
+    SnareDrum: {
+        'default': {},
+        'short': {'TONE_AMP_DECAY': 0.05, 'NOISE_AMP_DECAY': 0.05},
+        'long': {'TONE_AMP_DECAY': 1, 'NOISE_AMP_DECAY': 1, 'FREQ_DECAY': 1},
+    },
+    HighHat: {
+        'default': {},
+        'long': {'DECAY': 1},
+    },
+}
+# Realistic reverb lengths, from a small room to a large hall
+REVERB_DECAYS = [0.2, 0.5, 1]
+PULSE_TIMING_BPMS = [60, 120, 200]
+PULSE_TIMING_PULSES_PER_BEAT = 4
+# (playing, idle) sequencers on one shared engine
+SHARED_ENGINE_LOADS = [(1, 0), (1, 100), (8, 0), (32, 0)]
+# Run in a fresh interpreter, so nothing is already imported or synthesised. Mirrors the start of main.py, up to where
+# the GUI would be built
+STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+start = time.perf_counter()
+from unittest import mock
+sys.modules['simpleaudio'] = mock.MagicMock()
+sys.modules['tkinter'] = mock.MagicMock()
+
+import main
+from drums import BassDrum, HighHat, SnareDrum
+from sequencer import Sequencer, true_at_indices
+imported = time.perf_counter()
+
+sequencer = Sequencer(
+    pattern={BassDrum: true_at_indices([0, 8]), SnareDrum: true_at_indices([4, 12]), HighHat: [1, 1, 1, 0]},
+    bpm=110,
+)
+constructed = time.perf_counter()
+sequencer.drums
+ready = time.perf_counter()
+print(json.dumps({
+    'import_ms': 1e3 * (imported - start),
+    'sequencer_constructed_ms': 1e3 * (constructed - start),
+    'drums_ready_ms': 1e3 * (ready - start),
+}))
+'''
+
+
+def _percentiles(values, scale=1):
+    values = np.asarray(values) * scale
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def benchmark_synthesis(repeats: int) -> dict:
+    """
+    Time and peak traced memory of generate_sample, with the envelope cache cleared so every stage is measured
+    """
+    results = {}
+    for drum_class, parameter_sets in SYNTHESIS_PARAMETER_SETS.items():
+        for parameter_set_name, params in parameter_sets.items():
+            for float32_synthesis in (False, True):
+                drum = drum_class(**params)
+                drum.float32_synthesis = float32_synthesis
+                durations = []
+                for _ in range(repeats):
+                    drums.ENVELOPE_CACHE.clear()
+                    start = time.perf_counter()
+                    drum.generate_sample()
+                    durations.append(time.perf_counter() - start)
+
+                drums.ENVELOPE_CACHE.clear()
+                tracemalloc.start()
+                drum.generate_sample()
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                precision = 'float32' if float32_synthesis else 'float64'
+                results[f'synthesis/{drum_class.__name__}/{parameter_set_name}/{precision}'] = {
+                    **{f'{name}_ms': value for name, value in _percentiles(durations, 1e3).items()},
+                    'peak_bytes': peak_bytes,
+                    'n_samples': len(drum.T),
+                }
+    return results
+
+
+def benchmark_reverb(repeats: int) -> dict:
+    """
+    Time to add reverb to each drum's default sample, with the impulse response cached and with it built from scratch
+    """
+    results = {}
+    for drum_class in SYNTHESIS_PARAMETER_SETS:
+        drum = drum_class()
+        for decay in REVERB_DECAYS:
+            durations = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                drum._reverb(drum.sample, 0.3, decay)
+                durations.append(time.perf_counter() - start)
+
+            drums.reverb_impulse_response.cache_clear()
+            start = time.perf_counter()
+            drum._reverb(drum.sample, 0.3, decay)
+            uncached_duration = time.perf_counter() - start
+
+            results[f'reverb/{drum_class.__name__}/{decay}s'] = {
+                **{f'{name}_ms': value for name, value in _percentiles(durations, 1e3).items()},
+                'uncached_impulse_response_ms': uncached_duration * 1e3,
+                'n_samples': len(drum.sample),
+                'impulse_response_samples': int(decay * drums.SAMPLE_RATE),
+            }
+    return results
+
+
+def benchmark_pulse_timing(n_pulses: int) -> dict:
+    """
+    Lateness of each pulse relative to an ideal grid starting at the first one, and CPU used while waiting
+    """
+    results = {}
+    for bpm in PULSE_TIMING_BPMS:
+        sequencer = Sequencer(
+            pattern={BassDrum: [1, 0], SnareDrum: [0, 0, 1, 0], HighHat: [1]},
+            bpm=bpm,
+            pulses_per_beat=PULSE_TIMING_PULSES_PER_BEAT,
+        )
+        pulse_start_times = []
+        play_pulse = sequencer._play_pulse
+
+        def timed_play_pulse(*args):
+            pulse_start_times.append(time.perf_counter())
+            play_pulse(*args)
+
+        sequencer._play_pulse = timed_play_pulse
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(n_pulses):
+            sequencer.play_pulse()
+        cpu_fraction = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+        pulse_duration = sequencer._calculate_pulse_duration()
+        ideal_times = pulse_start_times[0] + np.arange(n_pulses) * pulse_duration
+        lateness = np.array(pulse_start_times) - ideal_times
+        results[f'pulse_timing/{bpm}bpm'] = {
+            **{f'lateness_{name}_ms': value for name, value in _percentiles(np.abs(lateness), 1e3).items()},
+            'final_drift_ms': float(lateness[-1] * 1e3),
+            'cpu_fraction': cpu_fraction,
+        }
+    return results
+
+
+def benchmark_shared_engine(n_blocks: int) -> dict:
+    """
+    CPU time per second of audio for many sequencers on one shared engine, run faster than real time
+    """
+    pattern = {BassDrum: true_at_indices([0, 8]), SnareDrum: true_at_indices([4, 12]), HighHat: [1, 1, 1, 0]}
+    results = {}
+    for n_playing, n_idle in SHARED_ENGINE_LOADS:
+        engine = SharedEngine(realtime=False)
+        sequencers = [Sequencer(pattern=pattern, shared_engine=engine) for _ in range(n_playing + n_idle)]
+        for sequencer in sequencers[:n_playing]:
+            sequencer.play()
+        cpu_start = time.process_time()
+        for _ in range(n_blocks):
+            engine.process_block()
+        cpu_seconds = time.process_time() - cpu_start
+        results[f'shared_engine/{n_playing}_playing_{n_idle}_idle'] = {
+            'cpu_fraction': cpu_seconds / (n_blocks * engine.block_duration),
+            'late_hits': engine.stats()['late_hits'],
+        }
+    return results
+
+
+class _EchoListener:
+    """
+    Plays both ends of the interface: answers each ping from the "GUI" with a pong from the "sequencer"
+    """
+    def __init__(self, sequencer_gui_interface, n_events):
+        self.sequencer_gui_interface = sequencer_gui_interface
+        self.round_trip_times = []
+        self.n_events = n_events
+        self.done = ThreadingEvent()
+
+    def ping(self, sent_at):
+        self.sequencer_gui_interface.push_to_gui_events_queue(GUIEvent('pong', {'sent_at': sent_at}))
+
+    def pong(self, sent_at):
+        self.round_trip_times.append(time.perf_counter() - sent_at)
+        if len(self.round_trip_times) == self.n_events:
+            self.done.set()
+
+
+def benchmark_event_round_trip(n_events: int) -> dict:
+    sequencer_gui_interface = SequencerGUIInterface()
+    echo = _EchoListener(sequencer_gui_interface, n_events)
+    for getter_func in (
+        sequencer_gui_interface.get_from_sequencer_events_queue,
+        sequencer_gui_interface.get_from_gui_events_queue,
+    ):
+        ListenerThread(listener=echo, getter_func=getter_func).start()
+
+    for _ in range(n_events):
+        sequencer_gui_interface.push_to_sequencer_events_queue(SequencerEvent('ping', {'sent_at': time.perf_counter()}))
+        # Space events out, so this measures latency rather than throughput
+        time.sleep(1e-3)
+    echo.done.wait(timeout=10)
+    sequencer_gui_interface.close()
+
+    return {
+        'event_round_trip': {
+            **{f'{name}_ms': value for name, value in _percentiles(echo.round_trip_times, 1e3).items()},
+            'n_received': len(echo.round_trip_times),
+        }
+    }
+
+
+def benchmark_startup(repeats: int) -> dict:
+    """
+    Time from interpreter start to the Sequencer being constructed (when the GUI could start being built) and to its
+    drums being ready, in fresh processes
+    """
+    measurements = []
+    process_durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT],
+            # So the script imports this repo's modules, wherever the benchmarks are run from
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        process_durations.append(time.perf_counter() - start)
+        measurements.append(json.loads(output))
+
+    return {
+        'startup': {
+            **{name: float(np.median([m[name] for m in measurements])) for name in measurements[0]},
+            'process_ms': float(np.median(process_durations) * 1e3),
+        }
+    }
+
+
+def _metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+    }
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Print the relative change of every metric also present in the baseline
+    """
+    for name, metrics in results.items():
+        baseline_metrics = baseline.get(name, {})
+        for metric, value in metrics.items():
+            baseline_value = baseline_metrics.get(metric)
+            if not baseline_value:
+                continue
+            print(f'{name:45} {metric:20} {baseline_value:12.4g} -> {value:12.4g} ({value / baseline_value - 1:+.1%})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='JSON file to write results to (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats, for a rough check')
+    parser.add_argument(
+        '--only',
+        choices=['synthesis', 'reverb', 'pulse_timing', 'shared_engine', 'event_round_trip', 'startup'],
+        action='append',
+        help='run only these benchmarks (may be repeated)',
+    )
+    args = parser.parse_args()
+
+    benchmarks = {
+        'synthesis': lambda: benchmark_synthesis(repeats=5 if args.quick else 50),
+        'reverb': lambda: benchmark_reverb(repeats=5 if args.quick else 50),
+        'pulse_timing': lambda: benchmark_pulse_timing(n_pulses=8 if args.quick else 64),
+        'shared_engine': lambda: benchmark_shared_engine(n_blocks=100 if args.quick else 1000),
+        'event_round_trip': lambda: benchmark_event_round_trip(n_events=20 if args.quick else 500),
+        'startup': lambda: benchmark_startup(repeats=3 if args.quick else 10),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if not args.only or name in args.only:
+            print(f'Running {name} benchmarks', file=sys.stderr)
+            results.update(benchmark())
+
+    output = json.dumps({'metadata': _metadata(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file)['results'])
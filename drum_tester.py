@@ -1,11 +1,11 @@
 import tkinter as tk
 
-import matplotlib
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
-matplotlib.use("TkAgg")
+import numpy as np
 
+from drums import add_profile_callback
 from drums import BassDrum
+from drums import SAMPLE_RATE
+from drums import SYNTHESIS_PROFILER
 
 
 class DrumTesterGUI(tk.Tk):
@@ -13,6 +13,7 @@ class DrumTesterGUI(tk.Tk):
         'PLAY_BUTTON': {'side': tk.RIGHT},
         'PARAMETER_CONTROLS': {'side': tk.RIGHT},
         'GRAPH': {'side': tk.TOP, 'fill': tk.BOTH, 'expand': 1},
+        'PROFILE': {'side': tk.LEFT},
     }
 
     TITLE = 'Drum Tester'
@@ -21,6 +22,8 @@ class DrumTesterGUI(tk.Tk):
 
     N_SLIDER_INCREMENTS = 1000
 
+    SAMPLE_POLL_INTERVAL_MS = 16
+
     def _get_play_button(self):
         tk.Button(self.frame, text='Play', command=self.drum.play).pack(**self.PACK_PARAMS['PLAY_BUTTON'])
 
@@ -34,8 +37,8 @@ class DrumTesterGUI(tk.Tk):
 
             def callback_factory(scale_param):
                 def func(new_value):
-                    self.drum.update_sample({scale_param: float(new_value)})
-                    self._draw_graph()
+                    # Synthesised in the background, so dragging a slider doesn't hold up the window
+                    self._wait_for_sample(self.drum.update_sample_async({scale_param: float(new_value)}))
                 return func
 
             slider = tk.Scale(
@@ -52,20 +55,76 @@ class DrumTesterGUI(tk.Tk):
             slider.set(value)
             slider.pack(side=tk.LEFT)
 
+    def _wait_for_sample(self, future):
+        if not future.done():
+            self.after(self.SAMPLE_POLL_INTERVAL_MS, self._wait_for_sample, future)
+            return
+        # Superseded samples are never swapped in, and the newer one redraws when it's ready
+        if not future.cancelled():
+            self.drum.refresh_sample()
+            self._draw_graph()
+            self._draw_profile()
+
     def _draw_graph(self):
+        if self.canvas is None:
+            return
         self.ax.clear()
-        self.ax.plot(self.drum.T, self.drum.sample, label='Waveform')
+        # Not the drum's time grid, which only covers the dry sample, since reverb adds a tail
+        sample_times = np.arange(len(self.drum.sample)) / SAMPLE_RATE
+        self.ax.plot(sample_times, self.drum.sample, label='Waveform')
 
         for envelope_name, envelope_values in self.drum.envelopes.items():
             normalised_enevelope_values = self.drum.sample.max() * envelope_values / envelope_values.max()
-            self.ax.plot(self.drum.T, normalised_enevelope_values, label=envelope_name)
+            self.ax.plot(sample_times[:len(envelope_values)], normalised_enevelope_values, label=envelope_name)
 
             self.ax.legend()
         self.canvas.draw()
 
+    def _get_profile_display(self):
+        # Times each stage. Bytes allocated are only measured while memory is traced, since that slows everything down
+        self.last_profile = None
+        add_profile_callback(self._on_sample_profiled)
+
+        self.trace_memory = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            self.frame, text='Trace memory', variable=self.trace_memory, command=self._on_trace_memory_toggled,
+        ).pack(**self.PACK_PARAMS['PROFILE'])
+        self.profile_label = tk.Label(self.frame, text='', justify=tk.LEFT, font='TkFixedFont')
+        self.profile_label.pack(**self.PACK_PARAMS['PROFILE'])
+
+    def _on_trace_memory_toggled(self):
+        if self.trace_memory.get():
+            SYNTHESIS_PROFILER.start()
+        else:
+            SYNTHESIS_PROFILER.stop()
+
+    def _on_sample_profiled(self, drum, profile):
+        # Background samples are generated on a copy of the drum, see `Drum.update_sample_async`
+        if type(drum) is type(self.drum):
+            self.last_profile = profile
+
+    def _draw_profile(self):
+        if self.last_profile is None:
+            return
+        if self.last_profile['cache_hit']:
+            self.profile_label.config(text='Cached sample')
+            return
+        lines = [f'Total {1e3 * self.last_profile["total_seconds"]:.2f} ms']
+        for stage, measurements in self.last_profile['stages'].items():
+            allocated = f'{measurements["bytes"] / 1024:.0f} KiB' if measurements['bytes'] is not None else ''
+            lines.append(f'{stage:11} {1e3 * measurements["seconds"]:6.2f} ms {allocated}')
+        self.profile_label.config(text='\n'.join(lines))
+
     def _get_graph(self):
+        # matplotlib is slow to import, so it's left until the rest of the window is up
+        import matplotlib
+        matplotlib.use("TkAgg")
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
+        from matplotlib.figure import Figure
+
         # Make plot
-        fig = matplotlib.figure.Figure(figsize=(5, 4), dpi=100)
+        fig = Figure(figsize=(5, 4), dpi=100)
         self.ax = fig.add_subplot(111)
         self.canvas = FigureCanvasTkAgg(fig, master=self)
 
@@ -88,9 +147,11 @@ class DrumTesterGUI(tk.Tk):
         self.frame.pack()
 
         # Create UI components
+        self.canvas = None
         self._get_play_button()
+        self._get_profile_display()
         self._get_parameter_controls()
-        self._get_graph()
+        self.after_idle(self._get_graph)
 
         # Focus on GUI window by default
         self.lift()
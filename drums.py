@@ -1,53 +1,742 @@
 import abc
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import itertools
+import os
 import re
+import tempfile
+from threading import local
+from threading import Lock
+import time
+import tracemalloc
+import wave
+import zlib
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Sequence
+from typing import Union
 import warnings
 
-# import matplotlib.pyplot as plt
 import numpy as np
-import simpleaudio as sa
 
+from voice_pool import remaining_level
+from voice_pool import VoicePool
 
 SAMPLE_RATE = 44100
 BIT_DEPTH = 16
 DRUM_END_PADDING_SAMPLES = 10
+SAMPLE_CACHE_MAX_SIZE = 256
+# Parameters are rounded to this many significant figures before being used as a cache key, so values that only differ
+# by floating point noise (e.g. from slider arithmetic) share a cached sample
+CACHE_KEY_SIGNIFICANT_FIGURES = 6
+SYNTHESIS_WORKERS = 2
+ENVELOPE_CACHE_MAX_BYTES = 32 * 2 ** 20
+DISK_CACHE_MAX_BYTES = 256 * 2 ** 20
+# Part of every disk cache file name. Bump it whenever a change to synthesis alters what the same parameters produce,
+# so samples cached on disk by older code are never used
+DISK_CACHE_VERSION = 1
+# Once over budget, the disk cache evicts down to this fraction of it, so it isn't back over after the next write
+DISK_CACHE_EVICT_TO_FRACTION = 0.9
+# The disk cache's directory is scanned at least this often, to catch up with samples written by other processes
+DISK_CACHE_RESCAN_WRITES = 64
+# The noise bank must be at least as long as the longest sample, see `NoiseBank`
+NOISE_BANK_SAMPLES = 4 * SAMPLE_RATE
+NOISE_BANK_SEED = 0
+REVERB_PARTITION_SIZE = 1024
+IMPULSE_RESPONSE_CACHE_MAX_SIZE = 16
+# Reverb level drops by this much over REVERB_DECAY
+REVERB_DECAY_DB = 60
+# Every drum has these. A REVERB_WET of 0 leaves the dry sample as it is
+REVERB_DEFAULT_PARAMS = {
+    'REVERB_WET': 0,
+    'REVERB_DECAY': 0.5,
+}
+
+
+class SampleCache:
+    """
+    LRU cache of generated samples, shared by all drums and keyed on drum class plus quantised parameters.
+
+    Values are (sample, envelopes) pairs. Samples are made read-only, since the same array may be handed to several
+    drums
+    """
+    def __init__(self, max_size: int = SAMPLE_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        # Samples may be generated on synthesis worker threads as well as the caller's
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'SampleCache {self.stats()}'
+
+    @staticmethod
+    def make_key(drum_class: type, params: dict, *options) -> tuple:
+        """
+        `options` are any other settings that change the sample, e.g. the synthesis precision
+        """
+        return (
+            drum_class.__name__,
+            tuple(sorted(
+                (name, float(f'{value:.{CACHE_KEY_SIGNIFICANT_FIGURES}g}')) for name, value in params.items()
+            )),
+            *options,
+        )
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, sample, envelopes):
+        sample.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (sample, envelopes)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+SAMPLE_CACHE = SampleCache()
+
+
+class EnvelopeCache:
+    """
+    LRU cache of decay envelopes, shared by all drums and keyed on (max_value, min_value, decay_time, length).
+
+    Most parameter edits leave most of a drum's envelopes unchanged, so they're usually a lookup. Envelopes are
+    read-only, and the cache is limited to `max_bytes` of them
+    """
+    def __init__(self, max_bytes: int = ENVELOPE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'EnvelopeCache {self.stats()}'
+
+    def get(self, max_value, min_value, decay_time, time_grid: np.ndarray, dtype=np.float64) -> np.ndarray:
+        key = (max_value, min_value, decay_time, len(time_grid), np.dtype(dtype))
+        with self._lock:
+            envelope = self._entries.get(key)
+            if envelope is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return envelope
+            self.misses += 1
+
+        envelope = self.build_envelope(max_value, min_value, decay_time, time_grid, dtype)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = envelope
+                self.n_bytes += envelope.nbytes
+            while self.n_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+                self.evictions += 1
+        return envelope
+
+    @staticmethod
+    def build_envelope(max_value, min_value, decay_time, time_grid: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """
+        Linear decay from `max_value` to `min_value` over `decay_time`, then held, filled into one preallocated array
+        """
+        envelope = np.empty(len(time_grid), dtype=dtype)
+        decay_end_point = min(int(decay_time * SAMPLE_RATE), len(time_grid))
+        decay_gradient = (min_value - max_value) / decay_time
+        decay_segment = envelope[:decay_end_point]
+        np.multiply(time_grid[:decay_end_point], decay_gradient, out=decay_segment)
+        decay_segment += max_value
+        envelope[decay_end_point:] = min_value
+        envelope.setflags(write=False)
+        return envelope
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'n_bytes': self.n_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+ENVELOPE_CACHE = EnvelopeCache()
+
+
+class DiskSampleCache:
+    """
+    Content-addressed store of generated samples in a directory, shared between processes and across restarts.
+
+    Each sample is a `.npy` file named by a hash of its `SampleCache` key plus `DISK_CACHE_VERSION`, `SAMPLE_RATE` and
+    `BIT_DEPTH`. Hits are memory-mapped read-only, so processes using the same sample share its pages rather than each
+    holding a copy. Files are written to a temporary name and renamed into place, so concurrent writers never expose a
+    partial file.
+
+    Once the directory holds more than `max_bytes` of samples, the least recently used files are removed, down to
+    `DISK_CACHE_EVICT_TO_FRACTION` of that. The directory's size is tracked as samples are written, and it's only
+    scanned when that goes over budget, or every `DISK_CACHE_RESCAN_WRITES` writes to catch up with other processes
+    """
+    def __init__(self, directory: str, max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.write_errors = 0
+        self.evictions = 0
+        # Guards the counters and size tracking, since samples are cached from the synthesis worker threads
+        self._lock = Lock()
+        # Bytes of samples in the directory, as of the last scan plus what's been written since, or None before a scan
+        self._n_bytes = None
+        self._writes_since_scan = 0
+
+    def __repr__(self):
+        return f'DiskSampleCache {self.stats()}'
+
+    def path(self, key: tuple) -> str:
+        digest = hashlib.sha256(repr((DISK_CACHE_VERSION, key, SAMPLE_RATE, BIT_DEPTH)).encode()).hexdigest()
+        return os.path.join(self.directory, f'{digest}.npy')
+
+    def get(self, key: tuple):
+        path = self.path(key)
+        try:
+            sample = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError):
+            # Unreadable, e.g. written by an incompatible numpy, so replace it
+            with contextlib.suppress(OSError):
+                self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+        # Modification time stands in for last use, since access times often aren't recorded
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return sample
+
+    def put(self, key: tuple, sample: np.ndarray) -> None:
+        """
+        Write a sample to the cache. If that fails, e.g. because the disk is full or the directory is read-only, the
+        sample just isn't cached, and the failure is warned about and counted in `write_errors`
+        """
+        try:
+            n_bytes = self._write(key, sample)
+            with self._lock:
+                self.writes += 1
+                self._writes_since_scan += 1
+                if self._n_bytes is not None:
+                    self._n_bytes += n_bytes
+                needs_scan = self._n_bytes is None or self._writes_since_scan >= DISK_CACHE_RESCAN_WRITES
+                if needs_scan or self._n_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as error:
+            with self._lock:
+                self.write_errors += 1
+            warnings.warn(f'Sample not written to the disk cache in {self.directory}: {error}')
+
+    def clear(self):
+        for path in self._sample_paths():
+            self._remove(path)
+        with self._lock:
+            self._n_bytes = None
+
+    def stats(self) -> dict:
+        return {
+            'n_bytes': sum(size for _, size, _ in self._sample_files()),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'write_errors': self.write_errors,
+            'evictions': self.evictions,
+        }
+
+    def _write(self, key, sample):
+        """
+        Write `sample` to its file, and return the file's size
+        """
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temporary_file:
+                np.save(temporary_file, sample)
+                n_bytes = temporary_file.tell()
+            os.replace(temporary_path, self.path(key))
+        except OSError:
+            self._remove(temporary_path)
+            raise
+        return n_bytes
+
+    def _sample_paths(self):
+        return glob.glob(os.path.join(self.directory, '*.npy'))
+
+    def _sample_files(self):
+        """
+        (last used, size, path) of every sample file, skipping any removed by another process part way through
+        """
+        files = []
+        for path in self._sample_paths():
+            with contextlib.suppress(FileNotFoundError):
+                file_stat = os.stat(path)
+                files.append((file_stat.st_mtime, file_stat.st_size, path))
+        return files
+
+    def _evict(self):
+        """
+        Scan the directory, and remove the least recently used files if it's over budget. Call holding the lock
+        """
+        files = sorted(self._sample_files())
+        n_bytes = sum(size for _, size, _ in files)
+        target_bytes = self.max_bytes * DISK_CACHE_EVICT_TO_FRACTION if n_bytes > self.max_bytes else self.max_bytes
+        for _, size, path in files:
+            if n_bytes <= target_bytes:
+                break
+            # Processes that already have the file mapped keep their pages until they let go of it
+            self._remove(path)
+            n_bytes -= size
+            self.evictions += 1
+        self._n_bytes = n_bytes
+        self._writes_since_scan = 0
+
+    @staticmethod
+    def _remove(path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+# Per-thread scratch space for the float32 synthesis path, reused between samples instead of allocated for each one
+_work_buffers = local()
+
+
+def _work_buffer(name: str, length: int) -> np.ndarray:
+    buffers = _work_buffers.__dict__
+    if name not in buffers or len(buffers[name]) < length:
+        buffers[name] = np.empty(length, dtype=np.float32)
+    return buffers[name][:length]
+
+
+_index_grid_float32 = None
+
+
+def _index_grid() -> np.ndarray:
+    """
+    Read-only float32 sample indices 0, 1, 2... covering one more than the longest sample
+    """
+    global _index_grid_float32
+    if _index_grid_float32 is None:
+        _index_grid_float32 = np.arange(len(Drum.T) + 1, dtype=np.float32)
+        _index_grid_float32.setflags(write=False)
+    return _index_grid_float32
+
+
+class NoiseBank:
+    """
+    Uniform noise in [0, 1), generated once from a seeded generator and shared by all drums.
+
+    Drums read read-only slices of it, at an offset fixed by the name they ask for, so the same drum with the same
+    parameters always gets the same noise, and so the same sample. The bank takes 4 bytes per sample, and is only
+    generated the first time it's used
+    """
+    def __init__(self, n_samples: int = NOISE_BANK_SAMPLES, seed: int = NOISE_BANK_SEED):
+        self.n_samples = n_samples
+        self.seed = seed
+        self._noise = None
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'NoiseBank (n_samples={self.n_samples}, seed={self.seed})'
+
+    @property
+    def key(self) -> tuple:
+        """
+        Identifies the noise in the bank, for use in sample cache keys
+        """
+        return self.n_samples, self.seed
+
+    def get(self, name: str, length: int) -> np.ndarray:
+        """
+        `length` samples of noise for `name`. The offset doesn't depend on `length`, so shorter requests for a name are
+        prefixes of longer ones
+        """
+        max_length = len(Drum.T)
+        if self.n_samples < max_length:
+            raise ValueError(f'Noise bank has {self.n_samples} samples, but needs at least {max_length}')
+        offset = zlib.crc32(name.encode()) % (self.n_samples - max_length + 1)
+        return self.noise[offset:offset + length]
+
+    @property
+    def noise(self) -> np.ndarray:
+        if self._noise is None:
+            with self._lock:
+                if self._noise is None:
+                    noise = np.random.default_rng(self.seed).random(self.n_samples, dtype=np.float32)
+                    noise.setflags(write=False)
+                    self._noise = noise
+        return self._noise
+
+
+NOISE_BANK = NoiseBank()
+
+
+class ImpulseResponse:
+    """
+    Reverb impulse response, prepared for uniformly partitioned overlap-add FFT convolution.
+
+    The response is split into partitions of `partition_size`, and each partition's spectrum is computed once here, so
+    convolving a signal takes one FFT of the signal's blocks, a multiply-add per partition and one inverse FFT
+    """
+    def __init__(self, response: np.ndarray, partition_size: int = REVERB_PARTITION_SIZE):
+        self.length = len(response)
+        self.partition_size = partition_size
+        partitions = np.zeros((-(-len(response) // partition_size), partition_size))
+        partitions.flat[:len(response)] = response
+        self.spectra = np.fft.rfft(partitions, n=2 * partition_size, axis=1)
+        self.spectra.setflags(write=False)
+
+    def __repr__(self):
+        return f'ImpulseResponse (length={self.length}, partitions={len(self.spectra)})'
+
+    @classmethod
+    def exponential_noise(cls, decay_time: float, noise: np.ndarray, partition_size: int = REVERB_PARTITION_SIZE):
+        """
+        Noise in [-1, 1) whose level falls by REVERB_DECAY_DB over `decay_time`, a simple diffuse tail
+        """
+        length = max(int(decay_time * SAMPLE_RATE), 1)
+        decay_rate = REVERB_DECAY_DB / 20 * np.log(10) / decay_time
+        response = (2 * noise[:length] - 1) * np.exp(-decay_rate * np.arange(length) / SAMPLE_RATE)
+        return cls(response, partition_size)
+
+    def convolve(self, signal: np.ndarray) -> np.ndarray:
+        """
+        Full convolution of `signal` with the response along its last axis, so `signal.shape[-1] + self.length - 1`
+        samples long
+        """
+        size = self.partition_size
+        n_samples = signal.shape[-1]
+        n_blocks = -(-n_samples // size)
+        blocks = np.zeros(signal.shape[:-1] + (n_blocks * size,))
+        blocks[..., :n_samples] = signal
+        block_spectra = np.fft.rfft(blocks.reshape(signal.shape[:-1] + (n_blocks, size)), n=2 * size, axis=-1)
+
+        # Output block k sums block k - j of the signal times partition j of the response, over every j. Loop over
+        # whichever of the two is shorter and vectorise over the other, adding in order of j either way so the result
+        # doesn't depend on which
+        n_partitions = len(self.spectra)
+        output_spectra = np.zeros(signal.shape[:-1] + (n_blocks + n_partitions - 1, size + 1), dtype=complex)
+        if n_partitions <= n_blocks:
+            for partition, spectrum in enumerate(self.spectra):
+                output_spectra[..., partition:partition + n_blocks, :] += block_spectra * spectrum
+        else:
+            for block in reversed(range(n_blocks)):
+                block_spectrum = block_spectra[..., block:block + 1, :]
+                output_spectra[..., block:block + n_partitions, :] += block_spectrum * self.spectra
+        output_blocks = np.fft.irfft(output_spectra, n=2 * size, axis=-1)
+
+        # Each output block is two partitions long, so overlaps the next by one
+        n_output_blocks = output_blocks.shape[-2]
+        output = np.zeros(signal.shape[:-1] + ((n_output_blocks + 1) * size,))
+        output[..., :-size] += output_blocks[..., :size].reshape(signal.shape[:-1] + (-1,))
+        output[..., size:] += output_blocks[..., size:].reshape(signal.shape[:-1] + (-1,))
+        return output[..., :n_samples + self.length - 1]
+
+
+@functools.lru_cache(maxsize=IMPULSE_RESPONSE_CACHE_MAX_SIZE)
+def reverb_impulse_response(decay_time: float, noise_bank: NoiseBank) -> ImpulseResponse:
+    """
+    Reverb impulse response of exponentially decaying noise from `noise_bank`, shared by all drums
+    """
+    return ImpulseResponse.exponential_noise(decay_time, noise_bank.get('reverb', len(Drum.T)))
+
+
+_synthesis_executor = None
+
+
+def get_synthesis_executor() -> ThreadPoolExecutor:
+    """
+    Shared pool for background sample generation, created on first use
+    """
+    global _synthesis_executor
+    if _synthesis_executor is None:
+        _synthesis_executor = ThreadPoolExecutor(max_workers=SYNTHESIS_WORKERS, thread_name_prefix='drum-synthesis')
+    return _synthesis_executor
+
+
+def write_wav(path: str, audio: np.ndarray) -> None:
+    """
+    Write mono int16 audio to a WAV file
+    """
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(BIT_DEPTH // 8)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(audio.astype('<i2').tobytes())
+
+
+# Profilers and callbacks receiving a breakdown of every `update_sample`. While both are empty, profiling costs nothing
+# beyond an attribute check per synthesis stage
+_active_profilers = []
+_profile_callbacks = []
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class SynthesisProfiler:
+    """
+    Aggregates the wall time and bytes allocated by each stage of sample generation, for every `update_sample` in the
+    process while it's active:
+
+        with SynthesisProfiler() as profiler:
+            drum.update_sample({'AMP_DECAY': 0.5})
+        print(profiler.format_report())
+
+    Bytes are the peak traced by tracemalloc during each stage, so are only measured while tracemalloc is tracing. With
+    `trace_memory`, the profiler starts tracing itself while it's active
+    """
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.n_updates = 0
+        self.n_cache_hits = 0
+        self._stage_totals = {}
+        self._lock = Lock()
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        _active_profilers.append(self)
+
+    def stop(self):
+        if self in _active_profilers:
+            _active_profilers.remove(self)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def record(self, drum: 'Drum', profile: dict) -> None:
+        with self._lock:
+            self.n_updates += 1
+            self.n_cache_hits += profile['cache_hit']
+            for stage, measurements in profile['stages'].items():
+                totals = self._stage_totals.setdefault(
+                    (drum.__class__.__name__, stage),
+                    {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0},
+                )
+                totals['count'] += 1
+                totals['seconds'] += measurements['seconds']
+                totals['max_seconds'] = max(totals['max_seconds'], measurements['seconds'])
+                totals['bytes'] += measurements['bytes'] or 0
+
+    def report(self) -> dict:
+        """
+        Totals for each drum class and stage, keyed as 'BassDrum/oscillator'
+        """
+        with self._lock:
+            return {f'{drum_name}/{stage}': dict(totals) for (drum_name, stage), totals in self._stage_totals.items()}
+
+    def format_report(self) -> str:
+        lines = [
+            f'{self.n_updates} updates, {self.n_cache_hits} cache hits',
+            f'{"stage":30} {"count":>6} {"mean ms":>9} {"max ms":>9} {"mean KiB":>9}',
+        ]
+        for name, totals in sorted(self.report().items()):
+            lines.append(
+                f'{name:30} {totals["count"]:6} {1e3 * totals["seconds"] / totals["count"]:9.3f} '
+                f'{1e3 * totals["max_seconds"]:9.3f} {totals["bytes"] / totals["count"] / 1024:9.1f}'
+            )
+        return '\n'.join(lines)
+
+
+# Process-wide profiler, off until `SYNTHESIS_PROFILER.start()`
+SYNTHESIS_PROFILER = SynthesisProfiler()
+
+
+def add_profile_callback(callback: Callable[['Drum', dict], None]) -> None:
+    """
+    Call `callback(drum, profile)` after every `update_sample`, where profile is a dict of `total_seconds`, `cache_hit`
+    and `stages`, mapping each stage name to its `seconds` and `bytes`
+    """
+    _profile_callbacks.append(callback)
+
+
+def remove_profile_callback(callback: Callable[['Drum', dict], None]) -> None:
+    _profile_callbacks.remove(callback)
+
+
+@contextlib.contextmanager
+def _profiled_stage(stages: dict, name: str):
+    measuring_memory = tracemalloc.is_tracing()
+    if measuring_memory:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        measurements = stages.setdefault(name, {'seconds': 0.0, 'bytes': 0 if measuring_memory else None})
+        measurements['seconds'] += time.perf_counter() - start_time
+        if measuring_memory:
+            measurements['bytes'] += tracemalloc.get_traced_memory()[1] - start_bytes
+
+
+class _LazyTimeGrid:
+    """
+    Class attribute holding the full-length time grid, which is only built when it's first used
+    """
+    def __init__(self):
+        self._time_grid = None
+
+    def __get__(self, instance, owner):
+        if self._time_grid is None:
+            self._time_grid = np.linspace(0, owner.SAMPLE_DURATION, owner.SAMPLE_DURATION * SAMPLE_RATE, False)
+        return self._time_grid
+
+
+class PlayObjectVoice:
+    """
+    A drum sample playing through simpleaudio, for `VoicePool`. Its position is estimated from when it started
+    """
+    def __init__(self, owner, sample: np.ndarray, play_object, choke_group=None):
+        self.owner = owner
+        self.sample = sample
+        self.play_object = play_object
+        self.choke_group = choke_group
+        self.start_time = time.perf_counter()
+
+    @property
+    def position(self) -> int:
+        return int((time.perf_counter() - self.start_time) * SAMPLE_RATE)
+
+    def is_playing(self) -> bool:
+        return self.play_object.is_playing()
+
+    def level(self) -> int:
+        return remaining_level(self.sample, self.position)
+
+    def stop(self):
+        self.play_object.stop()
+
+
+VOICE_POOL = VoicePool()
 
 
 class Drum(abc.ABC):
     SAMPLE_DURATION = 1
-    T = np.linspace(0, SAMPLE_DURATION, SAMPLE_DURATION * SAMPLE_RATE, False)
-    DT = T[1] - T[0]
+    T = _LazyTimeGrid()
+    DT = 1 / SAMPLE_RATE
 
     PARAMETER_RANGE_LOOKUP = {
         '^.*DECAY$': (1e-3, SAMPLE_DURATION),
         '^.*PITCH$': (2e1, 2e3),
         '^.*RATIO$': (0, 1),
         '^.*LEVEL': (0, 1),
+        '^.*WET$': (0, 1),
     }
 
+    sample_cache = SAMPLE_CACHE
+    envelope_cache = ENVELOPE_CACHE
+    noise_bank = NOISE_BANK
+    # Optional `DiskSampleCache`, checked after `sample_cache` misses. Samples loaded from it have no envelopes
+    disk_cache = None
+    # Limits how many voices `play` leaves sounding, or None for no limit
+    voice_pool = VOICE_POOL
+    # Optional `insert_chain.InsertChain` of effects run on the raw audio before it's normalised
+    insert_chain = None
+    # Drums in the same choke group cut each other off, like open and closed hats
+    CHOKE_GROUP = None
+    # If True, synthesise in float32 using reused work buffers and in-place operations. Faster and allocates far less,
+    # and matches the float64 path to within about 1e-3 of full scale
+    float32_synthesis = False
+    # Per-stage measurements of the `update_sample` in progress, or None when nothing is profiling
+    _profile_stages = None
+
     def __init__(self, **init_params):
-        self.params = self.DEFAULT_PARAMS
-        if init_params:
-            unrecognised_parameters = set(init_params.keys()) - set(self.DEFAULT_PARAMS.keys())
-            if unrecognised_parameters:
-                raise TypeError(f'Unrecognised parameters supplied: {unrecognised_parameters}')
-            self.params.update(init_params)
+        # Copy, so that updating one drum's parameters doesn't change the defaults for every other drum
+        self.params = self._with_defaults(init_params)
 
         self.parameter_ranges = {param: self._get_parameter_valid_range(param) for param in self.params.keys()}
         self._validate_params()
 
         self.envelopes = {}
         self.sample = None
+        # Guards `_pending_future` and `_ready_sample`, which background synthesis threads set when they finish
+        self._async_lock = Lock()
+        self._pending_future = None
+        self._ready_sample = None
 
         self.update_sample()
         self.play_object = None
 
     def play(self):
+        self.refresh_sample()
+        # Imported here so drums can be synthesised and rendered offline on machines without an audio backend
+        import simpleaudio as sa
         self.play_object = sa.play_buffer(self.sample, 1, 2, SAMPLE_RATE)
+        if self.voice_pool is not None:
+            self.voice_pool.add(PlayObjectVoice(self, self.sample, self.play_object, self.CHOKE_GROUP))
 
     def stop(self):
+        if self.voice_pool is not None:
+            self.voice_pool.stop(owner=self)
         if self.play_object and self.play_object.is_playing():
             self.play_object.stop()
 
+    # Names of the parameters that set how long the drum is audible for. Subclasses must define this
+    AMP_DECAY_PARAMS = []
+
     @abc.abstractmethod
     def generate_sample(self):
         pass
@@ -55,7 +744,193 @@ class Drum(abc.ABC):
     def update_sample(self, params={}):
         if params:
             self.params.update(params)
-        self.sample = self.generate_sample()
+        # Anything still being generated in the background is now out of date
+        with self._async_lock:
+            self._pending_future = None
+            self._ready_sample = None
+
+        profiling = bool(_active_profilers or _profile_callbacks)
+        if profiling:
+            self._profile_stages = {}
+            start_time = time.perf_counter()
+
+        # Only the audible part of the drum is synthesised, so shadow the full-length class time grid with a view of it.
+        # This covers the dry sample, and any reverb tail makes `sample` longer
+        self.T = Drum.T[:self._sample_length()]
+
+        # The dry sample is cached separately, so changing only the reverb doesn't synthesise the drum again
+        dry_cache_key = self._cache_key(self._dry_params())
+        reverb_wet = self.params['REVERB_WET']
+        cache_key = self._cache_key(self.params) if reverb_wet else dry_cache_key
+        cached = self._get_cached_sample(cache_key)
+        if cached is not None:
+            self.sample, envelopes = cached
+            self.envelopes = dict(envelopes)
+        else:
+            dry_cached = self._get_cached_sample(dry_cache_key) if reverb_wet else None
+            if dry_cached is not None:
+                dry_sample, envelopes = dry_cached
+                self.envelopes = dict(envelopes)
+            else:
+                self.envelopes = {}
+                dry_sample = self.generate_sample()
+                self._put_cached_sample(dry_cache_key, dry_sample)
+            self.sample = dry_sample
+            if reverb_wet:
+                self.sample = self._reverb(dry_sample, reverb_wet, self.params['REVERB_DECAY'])
+                self._put_cached_sample(cache_key, self.sample)
+
+        if profiling:
+            profile = {
+                'total_seconds': time.perf_counter() - start_time,
+                'cache_hit': cached is not None,
+                'stages': self._profile_stages,
+            }
+            self._profile_stages = None
+            for profiler in list(_active_profilers):
+                profiler.record(self, profile)
+            for callback in list(_profile_callbacks):
+                callback(self, profile)
+
+    def _dry_params(self):
+        return {name: value for name, value in self.params.items() if name not in REVERB_DEFAULT_PARAMS}
+
+    def _cache_key(self, params):
+        insert_chain_key = self.insert_chain.key if self.insert_chain is not None else ()
+        return self.sample_cache.make_key(
+            self.__class__, params, self.float32_synthesis, self.noise_bank.key, insert_chain_key)
+
+    def _get_cached_sample(self, cache_key):
+        """
+        (sample, envelopes) from the sample cache, then the disk cache, or None
+        """
+        cached = self.sample_cache.get(cache_key)
+        if cached is None and self.disk_cache is not None:
+            disk_sample = self.disk_cache.get(cache_key)
+            if disk_sample is not None:
+                cached = (disk_sample, {})
+                self.sample_cache.put(cache_key, disk_sample, {})
+        return cached
+
+    def _put_cached_sample(self, cache_key, sample):
+        self.sample_cache.put(cache_key, sample, dict(self.envelopes))
+        if self.disk_cache is not None:
+            self.disk_cache.put(cache_key, sample)
+
+    def set_insert_chain(self, insert_chain) -> None:
+        self.insert_chain = insert_chain
+        self.update_sample()
+
+    def update_sample_async(self, params={}) -> Future:
+        """
+        Like `update_sample`, but the sample is generated on a background thread.
+
+        The current sample keeps playing until the new one is ready, then it's swapped in at the next trigger (see
+        `refresh_sample`). A newer request supersedes an older one, which is cancelled if it hasn't started yet
+        """
+        if params:
+            self.params.update(params)
+
+        # The worker gets its own copy of the drum, so it never touches attributes in use on this thread
+        drum = copy.copy(self)
+        drum.params = dict(self.params)
+        drum._async_lock = Lock()
+        with self._async_lock:
+            superseded_future = self._pending_future
+            future = get_synthesis_executor().submit(self._generate_in_background, drum)
+            self._pending_future = future
+        # Outside the lock, since done callbacks, which take it, run straight away on futures that have finished
+        if superseded_future:
+            superseded_future.cancel()
+        future.add_done_callback(self._on_background_sample_ready)
+        return future
+
+    def refresh_sample(self) -> None:
+        """
+        Swap in the sample from `update_sample_async`, if one has finished since the last trigger
+        """
+        with self._async_lock:
+            ready_sample, self._ready_sample = self._ready_sample, None
+        if ready_sample is not None:
+            self.T, self.sample, self.envelopes = ready_sample
+
+    @staticmethod
+    def _generate_in_background(drum):
+        drum.update_sample()
+        return drum.T, drum.sample, drum.envelopes
+
+    def _on_background_sample_ready(self, future):
+        with self._async_lock:
+            # A newer request, or a synchronous update, has superseded this one
+            if future is not self._pending_future:
+                return
+            self._pending_future = None
+            if not future.cancelled() and future.exception() is None:
+                self._ready_sample = future.result()
+
+    @classmethod
+    def generate_batch(cls, param_grid: Union[Dict[str, Sequence[float]], List[dict]]) -> np.ndarray:
+        """
+        Synthesise many variants of this drum in one vectorised pass, with each variant as a row of 2-D arrays.
+
+        `param_grid` is either a list of parameter dicts, or a dict mapping parameter names to lists of values, which is
+        expanded to every combination of those values. Parameters that aren't given take their default values.
+
+        Returns an int16 array of shape (n_variants, n_samples). n_samples fits the longest variant, and shorter
+        variants are zero padded, so each row starts with exactly the sample the scalar path would produce for those
+        parameters
+        """
+        if isinstance(param_grid, dict):
+            names = list(param_grid.keys())
+            param_grid = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+
+        batch = cls.__new__(cls)
+        batch.parameter_ranges = {param: batch._get_parameter_valid_range(param) for param in cls.DEFAULT_PARAMS}
+        variants = [batch._with_defaults(variant) for variant in param_grid]
+        lengths = []
+        for variant in variants:
+            batch.params = variant
+            batch._validate_params()
+            lengths.append(batch._sample_length())
+        n_samples = max(lengths)
+
+        # Column vectors broadcast against the time grid, so the scalar synthesis code produces one row per variant
+        batch.params = {
+            param: np.array([variant[param] for variant in variants])[:, np.newaxis] for param in cls.DEFAULT_PARAMS
+        }
+        batch.T = Drum.T[:n_samples]
+        batch.envelopes = {}
+        batch.float32_synthesis = False
+        dry_samples = batch.generate_sample()
+        if not any(variant['REVERB_WET'] for variant in variants):
+            return dry_samples
+
+        # Impulse responses differ between variants, so reverb is added one variant at a time
+        samples = [
+            batch._reverb(dry_sample[:length], variant['REVERB_WET'], variant['REVERB_DECAY'])
+            if variant['REVERB_WET'] else dry_sample[:length]
+            for dry_sample, length, variant in zip(dry_samples, lengths, variants)
+        ]
+        padded_samples = np.zeros((len(samples), max(len(sample) for sample in samples)), dtype=np.int16)
+        for row, sample in zip(padded_samples, samples):
+            row[:len(sample)] = sample
+        return padded_samples
+
+    @classmethod
+    def validate_params(cls, params: dict) -> None:
+        """
+        Raise the error that constructing this drum with `params` would, without synthesising it
+        """
+        drum = cls.__new__(cls)
+        drum.params = drum._with_defaults(params)
+        drum.parameter_ranges = {param: drum._get_parameter_valid_range(param) for param in drum.params.keys()}
+        drum._validate_params()
+
+    def _with_defaults(self, params):
+        unrecognised_parameters = set(params.keys()) - set(self.DEFAULT_PARAMS.keys())
+        if unrecognised_parameters:
+            raise TypeError(f'Unrecognised parameters supplied: {unrecognised_parameters}')
+        return {**self.DEFAULT_PARAMS, **params}
 
     def _get_parameter_valid_range(self, parameter_name):
         for pattern, valid_range in self.PARAMETER_RANGE_LOOKUP.items():
@@ -71,32 +946,149 @@ class Drum(abc.ABC):
             if not valid_range[0] <= value <= valid_range[1]:
                 raise ValueError(f'{self.__class__.__name__} {name} = {value}, must be in the range {valid_range}')
 
+    def _stage(self, name):
+        """
+        Context manager timing one stage of synthesis, if `update_sample` is being profiled
+        """
+        if self._profile_stages is None:
+            return _NULL_STAGE
+        return _profiled_stage(self._profile_stages, name)
+
     def _decay_envelope(self, max_value, min_value, decay_time):
-        decay_end_point = int(decay_time * SAMPLE_RATE)
+        with self._stage('envelope'):
+            return self._build_decay_envelope(max_value, min_value, decay_time)
+
+    def _build_decay_envelope(self, max_value, min_value, decay_time):
+        if not any(np.ndim(value) for value in (max_value, min_value, decay_time)):
+            dtype = np.float32 if self.float32_synthesis else np.float64
+            return self.envelope_cache.get(max_value, min_value, decay_time, self.T, dtype)
+
+        # Column vectors of arguments, one row per variant (see `generate_batch`)
+        decay_end_point = np.asarray(decay_time * SAMPLE_RATE).astype(int)
         decay_gradient = (min_value - max_value) / decay_time
-        decay_segment = (self.T * decay_gradient + max_value)[:decay_end_point]
-        sustain_segment = np.repeat(min_value, len(self.T[decay_end_point:]))
-        return np.hstack([decay_segment, sustain_segment])
+        is_decaying = np.arange(len(self.T)) < decay_end_point
+        return np.where(is_decaying, self.T * decay_gradient + max_value, min_value)
 
     def _tone_drum_synth(self, start_pitch, end_pitch, amp_decay_time, freq_decay_time):
+        """
+        Sine wave with a linearly falling pitch. Not normalised
+        """
         pitch_envelope = self._decay_envelope(start_pitch, end_pitch, freq_decay_time)
         amp_envelope = self._decay_envelope(1, 0, amp_decay_time)
         self.envelopes['tone_pitch_envelope'] = pitch_envelope
         self.envelopes['tone_amp_envelope'] = amp_envelope
-        return self._normalise(amp_envelope * np.sin(2 * np.pi * pitch_envelope.cumsum() * self.DT))
+        with self._stage('oscillator'):
+            if not self.float32_synthesis:
+                return amp_envelope * np.sin(2 * np.pi * pitch_envelope.cumsum(axis=-1) * self.DT)
+
+            tone = self._linear_sweep_cycles(start_pitch, end_pitch, freq_decay_time, _work_buffer('tone', len(self.T)))
+            tone *= 2 * np.pi
+            np.sin(tone, out=tone)
+            tone *= amp_envelope
+            return tone
+
+    def _linear_sweep_cycles(self, start_pitch, end_pitch, freq_decay_time, out):
+        """
+        Closed form of `pitch_envelope.cumsum() * DT`, i.e. the number of cycles completed by each sample.
+
+        While the pitch is falling, the cumulative sum of the arithmetic series start_pitch + gradient * DT * i is
+        (i + 1) * (start_pitch + gradient * DT * i / 2). After that it grows by end_pitch per sample
+        """
+        indices = _index_grid()
+        decay_end_point = min(int(freq_decay_time * SAMPLE_RATE), len(out))
+        gradient = (end_pitch - start_pitch) / freq_decay_time
+
+        decay_segment = out[:decay_end_point]
+        np.multiply(indices[:decay_end_point], gradient * self.DT / 2, out=decay_segment)
+        decay_segment += start_pitch
+        decay_segment *= indices[1:decay_end_point + 1]
+        decay_segment *= self.DT
+
+        end_cycles = decay_end_point * (start_pitch + gradient * self.DT * (decay_end_point - 1) / 2) * self.DT
+        sustain_segment = out[decay_end_point:]
+        np.subtract(indices[decay_end_point:len(out)], decay_end_point - 1, out=sustain_segment)
+        sustain_segment *= end_pitch * self.DT
+        sustain_segment += end_cycles
+        return out
 
     def _noise_drum_synth(self, amp_decay_time):
+        """
+        Uniform noise with a linearly falling amplitude. Not normalised
+        """
         amp_envelope = self._decay_envelope(1, 0, amp_decay_time)
         self.envelopes['noise_amp_envelope'] = amp_envelope
-        return self._normalise(amp_envelope * np.random.uniform(size=len(self.T)))
+        with self._stage('noise'):
+            noise = self.noise_bank.get(self.__class__.__name__, len(self.T))
+            if not self.float32_synthesis:
+                return amp_envelope * noise
+            return np.multiply(amp_envelope, noise, out=_work_buffer('noise', len(self.T)))
+
+    def _mix(self, *weighted_components):
+        """
+        Sum of (audio, weight) pairs, with each component scaled to a peak of 1 before it's weighted.
+
+        In the float32 path this is done in place, in the first component's buffer
+        """
+        with self._stage('mix'):
+            if not self.float32_synthesis:
+                return sum(audio * (weight / self._peak(audio)) for audio, weight in weighted_components)
+
+            mix, weight = weighted_components[0]
+            mix *= weight / self._peak(mix)
+            for audio, weight in weighted_components[1:]:
+                audio *= weight / self._peak(audio)
+                mix += audio
+            return mix
 
     @staticmethod
     def _drum_end_index(amp_decay_time):
         return int(amp_decay_time * SAMPLE_RATE) + DRUM_END_PADDING_SAMPLES
 
+    def _sample_length(self):
+        """
+        Number of samples until the longest amplitude envelope has decayed, plus padding
+        """
+        end_index = max(self._drum_end_index(self.params[param]) for param in self.AMP_DECAY_PARAMS)
+        return min(end_index, len(Drum.T))
+
+    @staticmethod
+    def _peak(audio):
+        # Avoids the temporary array that np.abs would create
+        return np.maximum(audio.max(axis=-1, keepdims=True), -audio.min(axis=-1, keepdims=True))
+
     def _normalise(self, audio):
-        max_range = 2 ** (BIT_DEPTH - 1) - 1
-        return (self.params['AMP_LEVEL'] * audio * max_range / np.max(np.abs(audio))).astype(np.int16)
+        """
+        Run the insert chain, if there is one, then scale to AMP_LEVEL of full scale and convert to int16. Subclasses
+        should call this once, on their final mix
+        """
+        if self.insert_chain is not None:
+            with self._stage('insert_chain'):
+                audio = self.insert_chain.process(audio)
+        with self._stage('normalise'):
+            max_range = 2 ** (BIT_DEPTH - 1) - 1
+            scale = self.params['AMP_LEVEL'] * max_range / self._peak(audio)
+            # Memoised insert chain outputs are read-only
+            if not self.float32_synthesis or not audio.flags.writeable:
+                return (audio * scale).astype(np.int16)
+            audio *= scale
+            return audio.astype(np.int16)
+
+    def _reverb(self, dry_sample, wet, decay_time):
+        """
+        Mix of the dry sample and its convolution with a reverb impulse response, scaled to the dry sample's peak.
+        Longer than the dry sample by the reverb tail
+        """
+        with self._stage('reverb'):
+            # Rounded like cache keys, so decay times that only differ by floating point noise share a response
+            decay_time = float(f'{decay_time:.{CACHE_KEY_SIGNIFICANT_FIGURES}g}')
+            impulse_response = reverb_impulse_response(decay_time, self.noise_bank)
+            dry_audio = dry_sample.astype(np.float64)
+            wet_audio = impulse_response.convolve(dry_audio)
+            dry_peak = self._peak(dry_audio)
+            mix = wet_audio * (wet * dry_peak / self._peak(wet_audio))
+            mix[:len(dry_audio)] += (1 - wet) * dry_audio
+            mix *= dry_peak / self._peak(mix)
+            return mix.astype(np.int16)
 
 
 class BassDrum(Drum):
@@ -106,15 +1098,17 @@ class BassDrum(Drum):
         'AMP_DECAY': 0.3,
         'FREQ_DECAY': 0.2,
         'AMP_LEVEL': 1,
+        **REVERB_DEFAULT_PARAMS,
     }
+    AMP_DECAY_PARAMS = ['AMP_DECAY']
 
     def generate_sample(self):
-        return self._tone_drum_synth(
+        return self._normalise(self._tone_drum_synth(
             self.params['MAX_PITCH'],
             self.params['MIN_PITCH'],
             self.params['AMP_DECAY'],
             self.params['FREQ_DECAY'],
-        )
+        ))
 
 
 class SnareDrum(Drum):
@@ -126,7 +1120,9 @@ class SnareDrum(Drum):
         'NOISE_AMP_DECAY': 0.2,
         'NOISE_VOLUME_RATIO': 0.5,
         'AMP_LEVEL': 1,
+        **REVERB_DEFAULT_PARAMS,
     }
+    AMP_DECAY_PARAMS = ['TONE_AMP_DECAY', 'NOISE_AMP_DECAY']
 
     def generate_sample(self):
         tone_component = self._tone_drum_synth(
@@ -136,20 +1132,23 @@ class SnareDrum(Drum):
             freq_decay_time=self.params['FREQ_DECAY'],
         )
         noise_component = self._noise_drum_synth(amp_decay_time=self.params['NOISE_AMP_DECAY'])
-        return self._normalise(
-            tone_component * (1 - self.params['NOISE_VOLUME_RATIO'])
-            + noise_component * self.params['NOISE_VOLUME_RATIO']
-        )
+        return self._normalise(self._mix(
+            (tone_component, 1 - self.params['NOISE_VOLUME_RATIO']),
+            (noise_component, self.params['NOISE_VOLUME_RATIO']),
+        ))
 
 
 class HighHat(Drum):
     DEFAULT_PARAMS = {
         'DECAY': 0.03,
         'AMP_LEVEL': 0.3,
+        **REVERB_DEFAULT_PARAMS,
     }
+    AMP_DECAY_PARAMS = ['DECAY']
+    CHOKE_GROUP = 'hat'
 
     def generate_sample(self):
-        return self._noise_drum_synth(self.params['DECAY'])
+        return self._normalise(self._noise_drum_synth(self.params['DECAY']))
 
 
 if __name__ == '__main__':
@@ -171,6 +1170,7 @@ if __name__ == '__main__':
             high_hat.play()
             time.sleep(sleep_amount)
     if visualise:
+        import matplotlib.pyplot as plt
         bd = BassDrum()
         plt.plot(bd.T, bd.sample)
         plt.show()
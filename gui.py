@@ -29,6 +29,8 @@ class GUI(tk.Tk):
 
     N_SLIDER_INCREMENTS = 1000
 
+    TIMING_STATS_INTERVAL_MS = 250
+
     def __repr__(self):
         return f'Drum Machine GUI {id(self)}'
 
@@ -86,6 +88,28 @@ class GUI(tk.Tk):
                 # TODO: Remove this? Should the GUI know about every parameter it's sent?
                 continue
 
+    def show_timing_stats(self, **stats):
+        """
+        Called from the listener thread, so the stats are only recorded here, and drawn on the Tk thread
+        """
+        self._timing_stats = stats
+
+    def _draw_timing_stats(self):
+        stats, self._timing_stats = self._timing_stats, None
+        if stats and stats.get('n_pulses'):
+            self.timing_stats_label.config(text=(
+                f'Load {stats["load"]:.0%}\n'
+                f'Late p50 {stats["lateness_p50_ms"]:.1f} ms, p99 {stats["lateness_p99_ms"]:.1f} ms\n'
+                f'Missed {stats["missed_deadlines"]}, voices {stats["active_voices"]}'
+            ))
+        self.after(self.TIMING_STATS_INTERVAL_MS, self._draw_timing_stats)
+
+    def set_current_step(self, current_step):
+        self.param_controls['pattern'].set_current_step(current_step)
+
+    def _push_toggle_step(self, lane, step):
+        self._push_event_to_sequencer(SequencerEvent('toggle_step', {'lane': lane, 'step': step}))
+
     def _push_event_to_sequencer(self, event: SequencerEvent):
         self.sequencer_gui_interface.push_to_sequencer_events_queue(event)
 
@@ -133,6 +157,12 @@ class GUI(tk.Tk):
 
         param_controls['bpm'].set(99)
 
+        self.timing_stats_label = tk.Label(frame, text='', justify=tk.LEFT)
+        self.timing_stats_label.pack(side=tk.LEFT)
+        # Waiting to be drawn
+        self._timing_stats = None
+        self.after(self.TIMING_STATS_INTERVAL_MS, self._draw_timing_stats)
+
         return param_controls
 
     def _get_drum_controls(self):
@@ -163,7 +193,7 @@ class GUI(tk.Tk):
             bd=0,
         )
         frame.grid(column=1, row=0)
-        sequencer_grid = SequencerGrid(frame)
+        sequencer_grid = SequencerGrid(frame, on_toggle=self._push_toggle_step)
         tk.Label(frame, text='Sequencer Grid').pack()
         return {'pattern': sequencer_grid}
 
@@ -203,155 +233,128 @@ class GUI(tk.Tk):
 
 class SequencerGrid:
     """
-    Attributes
-        lanes
+    Canvas with a row of step cells for each lane of the pattern, and a marker on each lane's current step.
 
-    Methods
-        draw
+    Cells are canvas items indexed by [lane][step], so a click is mapped to its cell arithmetically. Changes are only
+    recorded as they arrive, and drawn together once every REDRAW_INTERVAL_MS on the Tk thread, so the marker moving
+    every pulse costs one batch of canvas updates per frame however big the grid is
     """
-    def __init__(self, parent):
-        HEIGHT = 200
-        WIDTH = 400
-
-        n_drums = 3
-        lane_height = int(HEIGHT / n_drums)
-
-        self.n_cells = 16
-
-        self.height = HEIGHT
-        self.width = WIDTH
+    HEIGHT = 200
+    WIDTH = 400
+    MARGIN = 1
+    MARKER_WIDTH = 5
+    REDRAW_INTERVAL_MS = 16
+
+    def __init__(self, parent, on_toggle: Callable = None):
+        self.height = self.HEIGHT
+        self.width = self.WIDTH
+        # Called with (lane, step) when a cell is clicked
+        self.on_toggle = on_toggle
         self.canvas = tk.Canvas(parent, bg=GRID_BACKGROUND_COLOUR, height=self.height, width=self.width)
         self.canvas.bind('<Button-1>', self.on_click)
+        self.canvas.pack()
 
-        self.lanes = list(reversed([
-            SequencerLane(
-                height=lane_height,
-                top=(lane_height * i),
-                grid=self,
-                _id=i,
-            ) for i in range(n_drums)
-        ]))
-
+        # Whether each step is on, for each lane. Lanes may have different numbers of steps
+        self.steps = []
         self.current_step = 0
-
-        self.current_step_marker = self.canvas.create_rectangle(
-            *self._get_current_step_marker_coords(),
-            outline=CURRENT_STEP_MARKER_COLOUR,
-            width=5,
-        )
-
-        self.canvas.pack()
+        self._cells = []
+        self._markers = []
+        self._lane_height = 0
+        self._cell_width = 0
+
+        # Waiting to be drawn
+        self._new_steps = None
+        self._dirty_cells = set()
+        self._current_step_moved = False
+
+        self.canvas.after(self.REDRAW_INTERVAL_MS, self._redraw)
+
+    def set(self, pattern):
+        """
+        Show a new pattern, given as a list of lanes of steps. Rebuilds the grid at the next redraw
+        """
+        self._new_steps = [[bool(step) for step in lane] for lane in pattern]
+
+    def set_current_step(self, current_step):
+        """
+        `current_step` counts pulses since the pattern started, so each lane's marker goes to its own step
+        """
+        self.current_step = current_step
+        self._current_step_moved = True
 
     def on_click(self, event):
-        for lane in self.lanes:
-            if event.y > lane.top:
-                return lane.on_click(event)
-
-    def _get_current_step_marker_coords(self):
-        cell_width = int(self.width / self.n_cells)
-        return [
-            self.current_step * cell_width,
-            0,
-            (self.current_step + 1) * cell_width,
-            self.height,
-        ]
-
-
-class SequencerLane:
-    """
-    Attributes:
-        cells
-
-    Methods:
-        draw
-
-    """
-
-    MARGIN = 1
-    COLOUR = LANE_COLOUR
-
-    def __init__(self, height, top, grid, _id):
-
-        self.height = height
-        self.top = top
-        self.grid = grid
-        self._id = _id
-
-        self.coords = [
-            self.MARGIN,
-            top + self.MARGIN,
-            grid.width - self.MARGIN,
-            top + height - self.MARGIN,
+        lane, step = int(event.y // max(self._lane_height, 1)), int(event.x // max(self._cell_width, 1))
+        if not (0 <= lane < len(self.steps) and 0 <= step < len(self.steps[lane])):
+            return
+        self.steps[lane][step] = not self.steps[lane][step]
+        self._dirty_cells.add((lane, step))
+        if self.on_toggle:
+            self.on_toggle(lane, step)
+
+    def _redraw(self):
+        if self._new_steps is not None:
+            self._build(self._new_steps)
+            self._new_steps = None
+
+        dirty_cells, self._dirty_cells = self._dirty_cells, set()
+        for lane, step in dirty_cells:
+            fill = CELL_ON_COLOUR if self.steps[lane][step] else CELL_OFF_COLOUR
+            self.canvas.itemconfig(self._cells[lane][step], fill=fill)
+
+        if self._current_step_moved:
+            self._current_step_moved = False
+            for lane, marker in enumerate(self._markers):
+                self.canvas.coords(marker, *self._get_current_step_marker_coords(lane))
+
+        self.canvas.after(self.REDRAW_INTERVAL_MS, self._redraw)
+
+    def _build(self, steps):
+        self.canvas.delete('all')
+        self.steps = steps
+        self._dirty_cells.clear()
+        n_steps = max((len(lane) for lane in steps), default=0)
+        self._lane_height = self.height / max(len(steps), 1)
+        self._cell_width = self.width / max(n_steps, 1)
+
+        self._cells = []
+        for lane, lane_steps in enumerate(steps):
+            top = lane * self._lane_height
+            self.canvas.create_rectangle(
+                self.MARGIN,
+                top + self.MARGIN,
+                self.width - self.MARGIN,
+                top + self._lane_height - self.MARGIN,
+                fill=LANE_COLOUR,
+            )
+            self._cells.append([
+                self.canvas.create_rectangle(
+                    step * self._cell_width + self.MARGIN,
+                    top + self.MARGIN,
+                    (step + 1) * self._cell_width - self.MARGIN,
+                    top + self._lane_height - self.MARGIN,
+                    fill=CELL_ON_COLOUR if is_on else CELL_OFF_COLOUR,
+                    outline=CELL_BORDER_COLOUR,
+                ) for step, is_on in enumerate(lane_steps)
+            ])
+
+        self._markers = [
+            self.canvas.create_rectangle(
+                *self._get_current_step_marker_coords(lane),
+                outline=CURRENT_STEP_MARKER_COLOUR,
+                width=self.MARKER_WIDTH,
+            ) for lane in range(len(steps))
         ]
 
-        self.grid.canvas.create_rectangle(
-            *self.coords,
-            fill=self.COLOUR,
-        )
-
-        cell_width = int(self.grid.width / self.grid.n_cells)
-
-        self.cells = list(reversed([
-            SequencerCell(
-                width=cell_width,
-                top=top,
-                right=(i * cell_width),
-                lane=self,
-                height=height,
-                _id=i,
-            ) for i in range(self.grid.n_cells)
-        ]))
-
-        for cell in self.cells:
-            cell.draw()
-
-    def on_click(self, event):
-        for cell in self.cells:
-            if event.x > cell.right:
-                return cell.on_click()
-
-
-class SequencerCell:
-    """
-    Attributes:
-        is_on
-        is_current
-
-    Methods:
-        draw
-        toggle
-    """
-
-    MARGIN = 1
-    COLOURS = {'OFF': CELL_OFF_COLOUR, 'ON': CELL_ON_COLOUR, 'BORDER': CELL_BORDER_COLOUR }
-
-    def __init__(self, width, top, height, right, lane, _id):
-        self.width = width
-        self.top = top
-        self.height = height
-        self.right = right
-        self.lane = lane
-        self._id = _id
-        self.is_on = False
-
-        self.coords = [
-            right + self.MARGIN,
-            top + self.MARGIN,
-            right + width - self.MARGIN,
-            top + height - self.MARGIN,
+    def _get_current_step_marker_coords(self, lane):
+        step = self.current_step % len(self.steps[lane])
+        top = lane * self._lane_height
+        return [
+            step * self._cell_width,
+            top,
+            (step + 1) * self._cell_width,
+            top + self._lane_height,
         ]
 
-        self.rectangle = self.lane.grid.canvas.create_rectangle(*self.coords, fill=self.COLOURS['OFF'], outline=self.COLOURS['BORDER'])
-
-    def toggle(self):
-        self.is_on = not self.is_on
-
-    def draw(self):
-        self.lane.grid.canvas.itemconfig(self.rectangle, fill=self.COLOURS['ON' if self.is_on else 'OFF'])
-
-    def on_click(self):
-        self.toggle()
-        self.draw()
 
 if __name__ == '__main__':
     sequencer_gui_interface = SequencerGUIInterface()
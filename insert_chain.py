@@ -0,0 +1,165 @@
+import functools
+import hashlib
+from typing import Sequence
+
+import numpy as np
+
+from drums import ImpulseResponse
+from drums import SAMPLE_RATE
+from drums import SampleCache
+
+FILTER_KINDS = ['lowpass', 'highpass', 'bandpass']
+FILTER_CACHE_MAX_SIZE = 64
+FILTER_PARTITION_SIZE = 256
+# Filter impulse responses are cut off once their poles have decayed to this fraction of their starting level
+FILTER_IMPULSE_RESPONSE_TOLERANCE = 1e-6
+DEFAULT_Q = 2 ** -0.5
+MIN_CUTOFF = 20
+SATURATOR_DEFAULT_DRIVE = 2
+SATURATOR_TABLE_SIZE = 4096
+# The table covers tanh of inputs in this range either side of zero. Beyond it tanh is within 1e-3 of +/-1
+SATURATOR_TABLE_RANGE = 4
+INSERT_CHAIN_CACHE_MAX_SIZE = 64
+
+_SATURATOR_TABLE = np.tanh(np.linspace(-SATURATOR_TABLE_RANGE, SATURATOR_TABLE_RANGE, SATURATOR_TABLE_SIZE))
+_SATURATOR_SLOPES = np.append(np.diff(_SATURATOR_TABLE), 0)
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_MAX_SIZE)
+def biquad_coefficients(kind: str, cutoff: float, q: float) -> tuple:
+    """
+    (b, a) coefficients of an RBJ cookbook biquad filter, normalised so that a[0] is 1
+    """
+    w0 = 2 * np.pi * cutoff / SAMPLE_RATE
+    cos_w0 = np.cos(w0)
+    alpha = np.sin(w0) / (2 * q)
+    if kind == 'lowpass':
+        b = np.array([(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2])
+    elif kind == 'highpass':
+        b = np.array([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2])
+    else:
+        b = np.array([alpha, 0, -alpha])
+    a = np.array([1 + alpha, -2 * cos_w0, 1 - alpha])
+    return tuple(b / a[0]), tuple(a / a[0])
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_MAX_SIZE)
+def biquad_impulse_response(kind: str, cutoff: float, q: float) -> ImpulseResponse:
+    """
+    The filter's impulse response, worked out in closed form from its poles rather than by running the recursion, and
+    cut off once it has died away
+    """
+    (b0, b1, b2), (_, a1, a2) = biquad_coefficients(kind, cutoff, q)
+    pole, other_pole = np.roots([1, a1, a2]).astype(complex)
+    pole_radius = max(abs(pole), abs(other_pole))
+    length = min(int(np.log(FILTER_IMPULSE_RESPONSE_TOLERANCE) / np.log(pole_radius)) + 3, SAMPLE_RATE)
+
+    # Response of the poles alone, which the zeros then mix delayed copies of
+    n = np.arange(length)
+    if np.isclose(pole, other_pole):
+        poles_response = ((n + 1) * pole ** n).real
+    else:
+        poles_response = ((pole ** (n + 1) - other_pole ** (n + 1)) / (pole - other_pole)).real
+    response = b0 * poles_response
+    response[1:] += b1 * poles_response[:-1]
+    response[2:] += b2 * poles_response[:-2]
+    return ImpulseResponse(response, FILTER_PARTITION_SIZE)
+
+
+class BiquadFilter:
+    """
+    Static low, high or band-pass filter. It's applied by FFT convolution with its impulse response, so it works on
+    whole arrays at once
+    """
+    def __init__(self, kind: str, cutoff: float, q: float = DEFAULT_Q):
+        if kind not in FILTER_KINDS:
+            raise ValueError(f'Filter kind {kind} must be one of {FILTER_KINDS}')
+        if not MIN_CUTOFF <= cutoff < SAMPLE_RATE / 2:
+            raise ValueError(f'Filter cutoff = {cutoff}, must be in the range [{MIN_CUTOFF}, {SAMPLE_RATE / 2})')
+        if q <= 0:
+            raise ValueError(f'Filter q = {q}, must be positive')
+        self.kind = kind
+        self.cutoff = float(cutoff)
+        self.q = float(q)
+
+    def __repr__(self):
+        return f'BiquadFilter ({self.kind}, cutoff={self.cutoff}, q={self.q})'
+
+    @property
+    def key(self) -> tuple:
+        return 'biquad', self.kind, self.cutoff, self.q
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        impulse_response = biquad_impulse_response(self.kind, self.cutoff, self.q)
+        return impulse_response.convolve(audio)[..., :audio.shape[-1]]
+
+
+class Saturator:
+    """
+    Soft clipper following a tanh curve, read from a precomputed table. Audio is scaled to a peak of `drive` first, so
+    how hard it clips doesn't depend on the level it comes in at
+    """
+    def __init__(self, drive: float = SATURATOR_DEFAULT_DRIVE):
+        if drive <= 0:
+            raise ValueError(f'Saturator drive = {drive}, must be positive')
+        self.drive = float(drive)
+
+    def __repr__(self):
+        return f'Saturator (drive={self.drive})'
+
+    @property
+    def key(self) -> tuple:
+        return 'saturator', self.drive
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        peak = np.maximum(audio.max(axis=-1, keepdims=True), -audio.min(axis=-1, keepdims=True))
+        peak[peak == 0] = 1
+        # Position in the table, split into an index and a fraction to interpolate by
+        position = audio * (self.drive * (SATURATOR_TABLE_SIZE - 1) / (2 * SATURATOR_TABLE_RANGE) / peak)
+        position += (SATURATOR_TABLE_SIZE - 1) / 2
+        np.clip(position, 0, SATURATOR_TABLE_SIZE - 1, out=position)
+        index = position.astype(np.intp)
+        position -= index
+        position *= _SATURATOR_SLOPES[index]
+        position += _SATURATOR_TABLE[index]
+        return position
+
+
+INSERT_CHAIN_CACHE = SampleCache(INSERT_CHAIN_CACHE_MAX_SIZE)
+
+
+class InsertChain:
+    """
+    Effects applied in order to a drum's raw synthesised audio, before it's normalised, see `Drum.set_insert_chain`.
+
+    Stages are objects with a `key` identifying their settings, and a `process(audio)` method that works along the last
+    axis of whole arrays. Outputs are memoised on a digest of the input audio plus the chain's key, so regenerating a
+    drum whose raw audio hasn't changed (e.g. only its level or reverb has) doesn't run the chain again
+    """
+    cache = INSERT_CHAIN_CACHE
+
+    def __init__(self, stages: Sequence = ()):
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return f'InsertChain {self.stages}'
+
+    @property
+    def key(self) -> tuple:
+        return tuple(stage.key for stage in self.stages)
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        if not self.stages:
+            return audio
+        audio = np.ascontiguousarray(audio)
+        digest = hashlib.blake2b(audio.data, digest_size=16).digest()
+        cache_key = (digest, audio.shape, audio.dtype.str, self.key)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached[0]
+
+        for stage in self.stages:
+            audio = stage.process(audio)
+        # Made read-only by the cache
+        self.cache.put(cache_key, audio, None)
+        return audio
@@ -1,23 +1,21 @@
-from typing import List
+import os
 
 from drums import BassDrum
+from drums import DiskSampleCache
+from drums import Drum
 from drums import HighHat
 from drums import SnareDrum
 from gui import GUI
 from sequencer import Sequencer
+from sequencer import true_at_indices
 from sequencer_gui_interface import SequencerGUIInterface
 
-
-def true_at_indices(indices: List[int], length: int = 16) -> List[bool]:
-    """
-    Zero-indexed indices only please
-    """
-    if max(indices) > length:
-        raise ValueError('indices cannot exceed list length')
-    return [i in indices for i in range(length)]
+# Synthesised samples are kept here between runs, so a kit that's been used before loads without any synthesis
+DISK_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'drum_machine')
 
 
 if __name__ == '__main__':
+    Drum.disk_cache = DiskSampleCache(DISK_CACHE_DIRECTORY)
     sequencer_gui_interface = SequencerGUIInterface()
 
     sequencer = Sequencer(
@@ -0,0 +1,73 @@
+import functools
+import math
+from typing import List
+from typing import Sequence
+
+import numpy as np
+
+
+class StepMatrix:
+    """
+    Drum pattern stored as a lanes x steps boolean matrix.
+
+    Each lane has its own length, so lanes of different lengths make polymeters. Lane `i` repeats every `lengths[i]`
+    pulses, and the whole pattern every `loop_length` pulses, the lowest common multiple of the lane lengths. Which
+    lanes fire on a pulse is one vectorised lookup, however many lanes and steps there are
+    """
+    def __init__(self, lanes: Sequence[Sequence[bool]]):
+        self.lengths = np.array([len(lane) for lane in lanes], dtype=int)
+        if not len(lanes) or not self.lengths.all():
+            raise ValueError('A pattern needs at least one lane, and every lane needs at least one step')
+        self.steps = np.zeros((len(lanes), self.lengths.max()), dtype=bool)
+        for lane_index, lane in enumerate(lanes):
+            self.steps[lane_index, :len(lane)] = np.asarray(lane, dtype=bool)
+        self._lane_indices = np.arange(len(lanes))
+
+    def __repr__(self):
+        return f'StepMatrix {self.lanes()}'
+
+    @property
+    def n_lanes(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def loop_length(self) -> int:
+        # In Python ints, since with many lanes of different lengths it can overflow int64
+        return functools.reduce(math.lcm, self.lengths.tolist())
+
+    def step_positions(self, pulse: int) -> np.ndarray:
+        """
+        The step each lane is on at `pulse`
+        """
+        return pulse % self.lengths
+
+    def fires(self, pulse: int) -> np.ndarray:
+        """
+        Boolean array of which lanes fire on `pulse`
+        """
+        return self.steps[self._lane_indices, pulse % self.lengths]
+
+    def hit_pulses(self, lane: int, n_pulses: int) -> np.ndarray:
+        """
+        Every pulse in the first `n_pulses` on which `lane` fires
+        """
+        length = self.lengths[lane]
+        steps_on = np.flatnonzero(self.steps[lane, :length])
+        pulses = (np.arange(0, n_pulses, length)[:, np.newaxis] + steps_on).ravel()
+        return pulses[pulses < n_pulses]
+
+    def toggle(self, lane: int, step: int) -> bool:
+        self._check_step(lane, step)
+        self.steps[lane, step] = not self.steps[lane, step]
+        return bool(self.steps[lane, step])
+
+    def set_step(self, lane: int, step: int, is_on: bool) -> None:
+        self._check_step(lane, step)
+        self.steps[lane, step] = is_on
+
+    def lanes(self) -> List[List[bool]]:
+        return [self.steps[lane, :length].tolist() for lane, length in enumerate(self.lengths)]
+
+    def _check_step(self, lane, step):
+        if not 0 <= step < self.lengths[lane]:
+            raise IndexError(f'Lane {lane} has {self.lengths[lane]} steps, so there is no step {step}')
@@ -1,15 +1,193 @@
-from itertools import cycle
-import sys
+from collections import deque
+from threading import Lock
 from threading import Thread
 import time
 from typing import Dict
 from typing import List
 
+import numpy as np
+
 from drums import BassDrum
+from drums import BIT_DEPTH
 from drums import Drum
+from drums import get_synthesis_executor
 from drums import HighHat
+from drums import SAMPLE_RATE
 from drums import SnareDrum
+from drums import write_wav
+from pattern import StepMatrix
 from sequencer_gui_interface import ListenerThread, GUIEvent
+from telemetry import PulseTelemetry
+
+BEATS_PER_BAR = 4
+# Waits sleep until this long before a pulse deadline, then spin, since sleep() can overshoot by a millisecond or so
+SPIN_SECONDS = 0.002
+# How often timing stats are pushed to the GUI
+TELEMETRY_PUSH_INTERVAL_PULSES = 32
+# Longest cycle a `LoopBuffer` will pre-render. Longer ones (e.g. polymeters of many coprime lane lengths) would take
+# hundreds of MB, so loop mode schedules their hits instead
+MAX_LOOP_SAMPLES = 60 * SAMPLE_RATE
+
+
+def true_at_indices(indices: List[int], length: int = 16) -> List[bool]:
+    """
+    Zero-indexed indices only please
+    """
+    if max(indices) > length:
+        raise ValueError('indices cannot exceed list length')
+    return [i in indices for i in range(length)]
+
+
+def calculate_pulse_duration(bpm: float, pulses_per_beat: int) -> float:
+    return 60 / (int(bpm) * int(pulses_per_beat))
+
+
+def add_hits(mix: np.ndarray, offsets: np.ndarray, sample: np.ndarray) -> None:
+    """
+    Add `sample` into `mix` starting at each of `offsets`. The loop is per hit, and each add is a slice, so this costs
+    about as much as touching the samples once
+    """
+    for offset in offsets.tolist():
+        mix[offset:offset + len(sample)] += sample
+
+
+def render_pattern(
+    lanes: Dict[Drum, List[bool]],
+    pulse_duration: float,
+    n_pulses: int,
+    loop: bool = True,
+) -> np.ndarray:
+    """
+    Mix `n_pulses` pulses of a pattern into one int16 buffer, much faster than real time.
+
+    If `loop` is True, the buffer is exactly `n_pulses` long and any tails that ring past the end are wrapped round to
+    the start, so the buffer repeats seamlessly. Otherwise it's extended to let the last hits ring out
+    """
+    n_samples = int(round(n_pulses * pulse_duration * SAMPLE_RATE))
+    pulse_offsets = np.round(np.arange(n_pulses) * pulse_duration * SAMPLE_RATE).astype(int)
+    max_sample_length = max((len(drum.sample) for drum in lanes), default=0)
+
+    mix = np.zeros(n_samples + max_sample_length, dtype=np.int32)
+    for drum, drum_pattern in lanes.items():
+        is_hit = np.resize(np.asarray(drum_pattern, dtype=bool), n_pulses)
+        add_hits(mix, pulse_offsets[is_hit], drum.sample)
+
+    if loop:
+        for tail_start in range(n_samples, len(mix), n_samples):
+            tail = mix[tail_start:tail_start + n_samples]
+            mix[:len(tail)] += tail
+        mix = mix[:n_samples]
+
+    max_range = 2 ** (BIT_DEPTH - 1) - 1
+    return np.clip(mix, -max_range - 1, max_range).astype(np.int16)
+
+
+class LoopBuffer:
+    """
+    One full cycle of a pattern, pre-rendered so it can be played on repeat without triggering any hits.
+
+    The cycle is `pattern.loop_length` pulses long, and tails that ring past its end wrap round to the start, so it
+    repeats seamlessly. The mix is kept as an unclipped int32 sum of every hit, so edits are applied incrementally:
+    toggling a step adds or subtracts just that step's hits, and a new drum sample replaces just that drum's hits.
+    Each edit builds a new mix and swaps it in, so a mixer thread reading the loop never sees an edit half applied.
+    Edits shouldn't be made from more than one thread at once. Changing the pulse duration needs a new LoopBuffer.
+
+    Cycles longer than `MAX_LOOP_SAMPLES` are refused, see `n_samples_for`
+    """
+    def __init__(self, drums: List[Drum], pattern: StepMatrix, pulse_duration: float):
+        self.n_samples = self.n_samples_for(pattern, pulse_duration)
+        if self.n_samples > MAX_LOOP_SAMPLES:
+            raise ValueError(
+                f'A cycle of this pattern is {self.n_samples} samples long, more than the {MAX_LOOP_SAMPLES} that a '
+                f'loop buffer can hold'
+            )
+        self.drums = drums
+        self.pattern = pattern
+        self.pulse_duration = pulse_duration
+        self.n_pulses = pattern.loop_length
+        self.pulse_offsets = np.round(np.arange(self.n_pulses) * pulse_duration * SAMPLE_RATE).astype(int)
+
+        self.mix = np.zeros(self.n_samples, dtype=np.int32)
+        # The drum sample each lane is currently mixed in with, and the same folded to fit the loop
+        self._mixed_samples = [None] * len(drums)
+        self._lane_samples = [None] * len(drums)
+        for lane in range(len(drums)):
+            self.update_drum(lane)
+
+    def __len__(self):
+        return self.n_samples
+
+    @staticmethod
+    def n_samples_for(pattern: StepMatrix, pulse_duration: float) -> int:
+        """
+        Length of a loop buffer of `pattern`, without building it
+        """
+        return int(round(pattern.loop_length * pulse_duration * SAMPLE_RATE))
+
+    def toggle(self, lane: int, step: int) -> None:
+        """
+        Toggle a step of the pattern, adding or removing its hits from the mix
+        """
+        is_on = self.pattern.toggle(lane, step)
+        hits = self._hits(self._lane_samples[lane], np.arange(step, self.n_pulses, self.pattern.lengths[lane]))
+        self.mix = self.mix + hits if is_on else self.mix - hits
+
+    def update_drum(self, lane: int) -> None:
+        """
+        Re-mix one lane's hits with its drum's current sample
+        """
+        hit_pulses = self.pattern.hit_pulses(lane, self.n_pulses)
+        old_lane_sample = self._lane_samples[lane]
+        self._mixed_samples[lane] = self.drums[lane].sample
+        self._lane_samples[lane] = self._fold(self._mixed_samples[lane].astype(np.int32))
+        mix = self.mix + self._hits(self._lane_samples[lane], hit_pulses)
+        if old_lane_sample is not None:
+            mix -= self._hits(old_lane_sample, hit_pulses)
+        self.mix = mix
+
+    def refresh_drums(self) -> None:
+        """
+        Re-mix any lanes whose drum has a new sample. Samples are replaced rather than modified, so this is cheap when
+        nothing has changed
+        """
+        for lane, drum in enumerate(self.drums):
+            drum.refresh_sample()
+            if drum.sample is not self._mixed_samples[lane]:
+                self.update_drum(lane)
+
+    def add_into(self, out: np.ndarray, position: int) -> None:
+        """
+        Add the loop into `out`, starting from `position` samples into it (which may be more than one cycle)
+        """
+        # Read once, since edits swap in a new mix
+        mix = self.mix
+        position %= self.n_samples
+        written = 0
+        while written < len(out):
+            n = min(len(out) - written, self.n_samples - position)
+            out[written:written + n] += mix[position:position + n]
+            written += n
+            position = 0
+
+    def _hits(self, sample, pulses):
+        """
+        `sample` hit at each of `pulses`, as a new array the length of the loop, with tails wrapped round to the start
+        """
+        unwrapped = np.zeros(self.n_samples + len(sample), dtype=np.int32)
+        add_hits(unwrapped, self.pulse_offsets[pulses], sample)
+        hits = unwrapped[:self.n_samples]
+        tail = unwrapped[self.n_samples:]
+        hits[:len(tail)] += tail
+        return hits
+
+    def _fold(self, sample):
+        """
+        Wrap a sample longer than the loop round onto itself, so that each hit touches each loop position once
+        """
+        if len(sample) <= self.n_samples:
+            return sample
+        folded = np.bincount(np.arange(len(sample)) % self.n_samples, weights=sample, minlength=self.n_samples)
+        return folded.astype(np.int32)
 
 
 class Sequencer:
@@ -49,6 +227,25 @@ class Sequencer:
 
     def __init__(self, pattern: Dict[Drum, List[bool]], **kwargs):
         self.sequencer_gui_interface = kwargs.pop('sequencer_gui_interface', None)
+        # If given, hits are scheduled on this `audio_engine.AudioEngine` instead of each drum playing itself
+        self.audio_engine = kwargs.pop('audio_engine', None)
+        # If given, this `shared_engine.SharedEngine` schedules pulses and supplies the drums, and hits are played on
+        # a bus of it writing to `sink`
+        self.shared_engine = kwargs.pop('shared_engine', None)
+        sink = kwargs.pop('sink', None)
+        # If True (needs `audio_engine`), one cycle of the pattern is pre-rendered and played on repeat, see
+        # `LoopBuffer`
+        self.loop_mode = kwargs.pop('loop_mode', False)
+        if self.loop_mode and (not self.audio_engine or self.shared_engine):
+            raise ValueError('Loop mode needs an audio engine of its own to play the loop')
+        self.loop_buffer = None
+        # Whether the pattern is being played from the loop buffer, which is only while playing in loop mode, and if
+        # the pattern's cycle isn't too long to pre-render
+        self.looping = False
+        # Serialises edits to the loop buffer (toggles from the GUI) with rebuilding it (tempo changes)
+        self._loop_lock = Lock()
+        self._next_pulse_frame = None
+        self._next_pulse_time = None
 
         self.params = {
             'playing': False,
@@ -56,9 +253,25 @@ class Sequencer:
             **{param: kwargs.pop(param, self.DEFAULT_PARAMS[param]) for param in self.BASIC_PARAM_NAMES},
         }
 
-        self.drum_patterns = {
-            drum(**kwargs): cycle(drum_pattern) for drum, drum_pattern in pattern.items()
-        }
+        # Drums are synthesised in the background, so e.g. the GUI can be built at the same time. See `drums`. Their
+        # parameters are checked now though, so mistakes fail here rather than wherever the drums are first used
+        for drum in pattern.keys():
+            drum.validate_params(kwargs)
+        if self.shared_engine:
+            self.audio_engine = self.shared_engine.attach(self, sink)
+            self._drum_futures = [self.shared_engine.drum_future(drum, **kwargs) for drum in pattern.keys()]
+        else:
+            executor = get_synthesis_executor()
+            self._drum_futures = [executor.submit(drum, **kwargs) for drum in pattern.keys()]
+        self._drums = None
+        # Lanes are in the same order as `drums`
+        self.pattern = StepMatrix(list(pattern.values()))
+        # Number of pulses played since the pattern started
+        self.pulse = 0
+        # (frame, pulse) of pulses scheduled on the audio engine that the GUI hasn't been told about yet, since the
+        # engine hasn't reached them
+        self._scheduled_steps = deque()
+        self.telemetry = PulseTelemetry(n_lanes=len(pattern))
 
         # Start listening for messages from GUI
         if self.sequencer_gui_interface:
@@ -68,38 +281,213 @@ class Sequencer:
                 getter_func=self.sequencer_gui_interface.get_from_sequencer_events_queue,
             ).start()
 
+    @property
+    def drums(self) -> List[Drum]:
+        """
+        The drum for each lane of the pattern. Waits for the drums to be synthesised, the first time it's used
+        """
+        if self._drums is None:
+            self._drums = [future.result() for future in self._drum_futures]
+        return self._drums
+
+    @property
+    def current_step(self) -> np.ndarray:
+        """
+        The step each lane will play next
+        """
+        return self.pattern.step_positions(self.pulse)
+
+    def toggle_step(self, lane: int, step: int) -> None:
+        with self._loop_lock:
+            if self.loop_buffer:
+                # Toggles the pattern too
+                self.loop_buffer.toggle(lane, step)
+            else:
+                self.pattern.toggle(lane, step)
+
     def _calculate_pulse_duration(self):
-        return 60 / (int(self.params['bpm']) * int(self.params['pulses_per_beat']))
+        return calculate_pulse_duration(self.params['bpm'], self.params['pulses_per_beat'])
 
-    def _play_pulse(self):
-        for drum, drum_pattern in self.drum_patterns.items():
-            if next(drum_pattern):
-                drum.play()
+    def _play_pulse(self, scheduled_time, pulse_duration):
+        trigger_times = self.telemetry.begin_pulse(scheduled_time, time.perf_counter(), pulse_duration)
+        drums = self.drums
+        for lane in np.flatnonzero(self.pattern.fires(self.pulse)):
+            drums[lane].play()
+            trigger_times[lane] = time.perf_counter()
+        self.telemetry.end_pulse(time.perf_counter())
+        self._advance_pulse()
+
+    def _advance_pulse(self, frame: float = None):
+        """
+        Move on to the next pulse. If the current one was scheduled at `frame` on the audio engine, the GUI is only
+        told about it once the engine gets there, see `push_reached_steps`
+        """
+        if self.sequencer_gui_interface:
+            if frame is None:
+                self._push_current_step(self.pulse)
+            else:
+                self._scheduled_steps.append((frame, self.pulse))
+        self.pulse += 1
+
+    def push_reached_steps(self):
+        """
+        Tell the GUI about the latest scheduled pulse the audio engine has reached, if it hasn't been told yet
+        """
+        reached_pulse = None
+        while self._scheduled_steps and self._scheduled_steps[0][0] <= self.audio_engine.frame:
+            _, reached_pulse = self._scheduled_steps.popleft()
+        if reached_pulse is not None:
+            self._push_current_step(reached_pulse)
+
+    def _push_current_step(self, pulse):
+        self.sequencer_gui_interface.push_to_gui_events_queue(GUIEvent('set_current_step', {'current_step': pulse}))
 
     def _push_initial_params_to_gui(self):
-        self.sequencer_gui_interface.push_to_gui_events_queue(GUIEvent('initialise_params', self.params))
+        # The GUI is sent the pattern's lanes, in the same order as `drums`
+        params = {**self.params, 'pattern': self.pattern.lanes()}
+        self.sequencer_gui_interface.push_to_gui_events_queue(GUIEvent('initialise_params', params))
 
-    def _wait_pulse_done(self, cycle_start_time):
-        pulse_duration = self._calculate_pulse_duration()
-        while time.time() - cycle_start_time <= pulse_duration:
+    def _push_timing_stats_to_gui(self):
+        self.sequencer_gui_interface.push_to_gui_events_queue(GUIEvent('show_timing_stats', self.timing_stats()))
+
+    def timing_stats(self) -> dict:
+        """
+        Summary of how late recent pulses and hits were, see `PulseTelemetry.stats`, and how many voices are sounding
+        """
+        voice_pool = self.audio_engine.voice_pool if self.audio_engine else Drum.voice_pool
+        active_voices = len(voice_pool) if voice_pool is not None else None
+        return {**self.telemetry.stats(), 'active_voices': active_voices}
+
+    @staticmethod
+    def _wait_until(deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > SPIN_SECONDS:
+            time.sleep(remaining - SPIN_SECONDS)
+        while time.perf_counter() < deadline:
             continue
 
     def play_pulse(self):
-        pulse_start_time = time.time()
-        self._play_pulse()
-        self._wait_pulse_done(pulse_start_time)
+        if self._next_pulse_time is None:
+            self._next_pulse_time = time.perf_counter()
+        # The duration is read every pulse, so bpm changes apply from the next one
+        pulse_duration = self._calculate_pulse_duration()
+        self._play_pulse(self._next_pulse_time, pulse_duration)
+        if self.sequencer_gui_interface and self.telemetry.n_pulses % TELEMETRY_PUSH_INTERVAL_PULSES == 0:
+            self._push_timing_stats_to_gui()
+
+        # Deadlines count on from a fixed start rather than from when each pulse actually began, so an overrun in one
+        # pulse doesn't delay every later one
+        self._next_pulse_time += pulse_duration
+        now = time.perf_counter()
+        if now - self._next_pulse_time > pulse_duration:
+            # More than a whole pulse behind (e.g. the process was suspended), so start counting again from now rather
+            # than rushing through the missed pulses
+            self._next_pulse_time = now
+        self._wait_until(self._next_pulse_time)
+
+    def schedule_pulses(self):
+        """
+        Schedule the hits of every pulse that starts within the audio engine's lookahead window, and move the GUI's
+        marker on to the pulse the engine is up to
+        """
+        self.push_reached_steps()
+        if self._next_pulse_frame is None:
+            self._next_pulse_frame = self.audio_engine.frame + self.audio_engine.lookahead_frames
+        horizon = self.audio_engine.frame + self.audio_engine.lookahead_frames
+        while self._next_pulse_frame < horizon:
+            self._next_pulse_frame = self.schedule_pulse(self._next_pulse_frame)
+
+    def schedule_pulse(self, frame: float) -> float:
+        """
+        Schedule the hits of the next pulse on the audio engine at `frame`, and return the frame the pulse after starts
+        """
+        drums = self.drums
+        for lane in np.flatnonzero(self.pattern.fires(self.pulse)):
+            drum = drums[lane]
+            drum.refresh_sample()
+            self.audio_engine.schedule(drum.sample, int(round(frame)), drum, drum.CHOKE_GROUP)
+        self._advance_pulse(frame)
+        return frame + self._calculate_pulse_duration() * SAMPLE_RATE
+
+    def update_loop(self):
+        """
+        Keep the loop buffer in step with the tempo and drums, and the GUI in step with the loop.
+
+        A tempo change re-renders the loop, lined up so the pattern carries on from the next pulse. New drum samples
+        only re-mix their own lanes. If the loop would be too long to render, it's stopped and `looping` is cleared,
+        so the pattern carries on from the next pulse with its hits scheduled instead
+        """
+        engine = self.audio_engine
+        if self._next_pulse_frame is None:
+            self._next_pulse_frame = engine.frame + engine.lookahead_frames
+        pulse_duration = self._calculate_pulse_duration()
+        drums = self.drums
+        with self._loop_lock:
+            # Stopped while waiting for the drums or the lock, so mustn't start the loop again
+            if not self.params['playing']:
+                return
+            if self.loop_buffer is None or self.loop_buffer.pulse_duration != pulse_duration:
+                if LoopBuffer.n_samples_for(self.pattern, pulse_duration) > MAX_LOOP_SAMPLES:
+                    engine.stop_loop()
+                    self.loop_buffer = None
+                    self.looping = False
+                else:
+                    loop_buffer = LoopBuffer(drums, self.pattern, pulse_duration)
+                    next_pulse_offset = loop_buffer.pulse_offsets[self.pulse % loop_buffer.n_pulses]
+                    engine.play_loop(loop_buffer, int(round(self._next_pulse_frame)) - next_pulse_offset)
+                    self.loop_buffer = loop_buffer
+            else:
+                self.loop_buffer.refresh_drums()
+
+        while self._next_pulse_frame <= engine.frame:
+            self._advance_pulse()
+            self._next_pulse_frame += pulse_duration * SAMPLE_RATE
 
     def play_or_stop(self):
         self.params['playing'] = not self.params['playing']
-        if self.params['playing']:
+        if self.shared_engine:
+            if self.params['playing']:
+                self.shared_engine.play_sequencer(self)
+            else:
+                self.shared_engine.stop_sequencer(self)
+        elif self.params['playing']:
+            self._next_pulse_time = None
+            if self.audio_engine:
+                self._next_pulse_frame = None
+                self.looping = self.loop_mode
+                if not self.loop_mode and not self.audio_engine.running:
+                    # The mixer fills its ring buffer as soon as it starts, so schedule the first window before then
+                    self._next_pulse_frame = self.audio_engine.frame
+                    self.schedule_pulses()
+                self.audio_engine.start()
             PlayThread(self).start()
+        elif self.loop_mode:
+            # Even if there's no loop buffer yet, since the play thread may be about to start one
+            with self._loop_lock:
+                self.audio_engine.stop_loop()
+                self.loop_buffer = None
 
     play = play_or_stop
 
+    def render(self, n_bars: int, loop: bool = True) -> np.ndarray:
+        """
+        Render `n_bars` bars of the pattern offline, without waiting for real time or needing an audio backend
+        """
+        n_pulses = n_bars * BEATS_PER_BAR * int(self.params['pulses_per_beat'])
+        lanes = dict(zip(self.drums, self.pattern.lanes()))
+        return render_pattern(lanes, self._calculate_pulse_duration(), n_pulses, loop)
+
+    def export_wav(self, path: str, n_bars: int, loop: bool = True) -> None:
+        write_wav(path, self.render(n_bars, loop))
+
     def quit(self):
-        # TODO: this doesn't stop everything running
         self.params['playing'] = False
-        sys.exit()
+        if self.shared_engine:
+            self.shared_engine.detach(self)
+        elif self.audio_engine:
+            self.audio_engine.stop()
+        if self.sequencer_gui_interface:
+            self.sequencer_gui_interface.close()
 
 
 class PlayThread(Thread):
@@ -108,6 +496,17 @@ class PlayThread(Thread):
         self.sequencer = sequencer
 
     def run(self):
+        if self.sequencer.audio_engine:
+            # The engine takes care of exact timing, so just top up its schedule about once per block. A loop plays
+            # itself, so then this only has edits and the GUI to keep up with
+            while self.sequencer.params['playing']:
+                if self.sequencer.looping:
+                    self.sequencer.update_loop()
+                else:
+                    self.sequencer.schedule_pulses()
+                time.sleep(self.sequencer.audio_engine.block_duration)
+            return
+
         while self.sequencer.params['playing']:
             self.sequencer.play_pulse()
 
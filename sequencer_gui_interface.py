@@ -1,8 +1,11 @@
+from collections import deque
+from queue import Empty
 from queue import Queue
 import re
+from threading import Condition
 from threading import Thread
-import time
 from typing import Callable
+from typing import Optional
 from typing import Union
 
 
@@ -27,6 +30,52 @@ class GUIEvent(Event):
     pass
 
 
+# Sentinel telling a ListenerThread to finish
+STOP_LISTENING_EVENT = Event('stop_listening')
+
+
+class CoalescingQueue:
+    """
+    Event queue where a new `set_*` event replaces a `set_*` event of the same name that's still waiting, so only the
+    latest value is delivered, in the place of the first one queued. Other events are never coalesced, so they keep
+    their order.
+
+    Has the same `put`/`get`/`qsize` interface as `queue.Queue`
+    """
+    def __init__(self):
+        # Entries are one-item lists, so a waiting `set_*` event can be replaced without searching the deque
+        self._entries = deque()
+        self._waiting_setters = {}
+        self._condition = Condition()
+        self.coalesced_count = 0
+
+    def put(self, event: Event) -> None:
+        with self._condition:
+            entry = self._waiting_setters.get(event.method)
+            if entry is not None:
+                entry[0] = event
+                self.coalesced_count += 1
+                return
+            entry = [event]
+            self._entries.append(entry)
+            if event.method.startswith('set_'):
+                self._waiting_setters[event.method] = entry
+            self._condition.notify()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Event:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._entries, timeout if block else 0):
+                raise Empty
+            entry = self._entries.popleft()
+            event = entry[0]
+            if self._waiting_setters.get(event.method) is entry:
+                del self._waiting_setters[event.method]
+            return event
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+
 class SequencerGUIInterface:
     """
     Maintains event queues so the sequence object and the GUI can intercommunicate.
@@ -35,10 +84,13 @@ class SequencerGUIInterface:
 
     Event consumers should look for events with the name set_* and automatically set that attribute value. This will
     save writing heaps of setter functions explicitly.
+
+    By default the queues coalesce `set_*` events (see CoalescingQueue), so dragging a slider can't flood the consumer
     """
-    def __init__(self):
-        self._sequencer_events_queue = Queue()
-        self._gui_events_queue = Queue()
+    def __init__(self, coalesce: bool = True):
+        queue_class = CoalescingQueue if coalesce else Queue
+        self._sequencer_events_queue = queue_class()
+        self._gui_events_queue = queue_class()
 
     def push_to_sequencer_events_queue(self, event: SequencerEvent) -> None:
         self._sequencer_events_queue.put(event)
@@ -46,32 +98,64 @@ class SequencerGUIInterface:
     def push_to_gui_events_queue(self, event: GUIEvent) -> None:
         self._gui_events_queue.put(event)
 
-    def get_from_sequencer_events_queue(self) -> Union[SequencerEvent, None]:
-        if self._sequencer_events_queue.empty():
+    def get_from_sequencer_events_queue(
+        self,
+        block: bool = False,
+        timeout: Optional[float] = None,
+    ) -> Union[SequencerEvent, None]:
+        return self._get(self._sequencer_events_queue, block, timeout)
+
+    def get_from_gui_events_queue(self, block: bool = False, timeout: Optional[float] = None) -> Union[GUIEvent, None]:
+        return self._get(self._gui_events_queue, block, timeout)
+
+    def queue_stats(self) -> dict:
+        return {
+            name: {'depth': queue.qsize(), 'coalesced': getattr(queue, 'coalesced_count', 0)}
+            for name, queue in [
+                ('sequencer_events', self._sequencer_events_queue),
+                ('gui_events', self._gui_events_queue),
+            ]
+        }
+
+    def close(self) -> None:
+        """
+        Stop the listeners on both queues once they've handled the events already queued
+        """
+        self._sequencer_events_queue.put(STOP_LISTENING_EVENT)
+        self._gui_events_queue.put(STOP_LISTENING_EVENT)
+
+    @staticmethod
+    def _get(queue: Queue, block: bool, timeout: Optional[float]) -> Union[Event, None]:
+        try:
+            return queue.get(block, timeout)
+        except Empty:
             return None
-        return self._sequencer_events_queue.get()
-
-    def get_from_gui_events_queue(self) -> Union[GUIEvent, None]:
-        if self._gui_events_queue.empty():
-            return None
-        return self._gui_events_queue.get()
 
 
 class ListenerThread(Thread):
     """
-    Allows an object to poll queues for events
+    Waits on a queue and passes its events to an object, draining everything queued each time it wakes up.
+
+    Finishes on STOP_LISTENING_EVENT or `stop()`
     """
+    # Longest wait before noticing `stop()`. Events are handled as soon as they arrive regardless
     POLL_INTERVAL_SECONDS = 0.1
 
     def __init__(self, listener: Union['GUI', 'Sequencer'], getter_func: Callable):
-        super().__init__()
+        super().__init__(daemon=True)
         self.listener = listener
         self.getter_func = getter_func
+        self.running = True
+
+    def stop(self):
+        self.running = False
 
     def run(self):
-        while True:
-            time.sleep(self.POLL_INTERVAL_SECONDS)
-            event = self.getter_func()
-            if event is None:
-                continue
-            getattr(self.listener, event.method)(**event.method_args)
+        while self.running:
+            event = self.getter_func(block=True, timeout=self.POLL_INTERVAL_SECONDS)
+            while event is not None:
+                if event is STOP_LISTENING_EVENT:
+                    self.running = False
+                    return
+                getattr(self.listener, event.method)(**event.method_args)
+                event = self.getter_func()
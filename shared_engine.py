@@ -0,0 +1,186 @@
+from concurrent.futures import Future
+import heapq
+import itertools
+from threading import Lock
+from threading import Thread
+import time
+
+from audio_engine import AudioEngine
+from audio_engine import BLOCK_SIZE
+from audio_engine import LOOKAHEAD_SECONDS
+from audio_engine import NullSink
+from drums import get_synthesis_executor
+from drums import SAMPLE_RATE
+from drums import SampleCache
+
+
+class SharedEngine:
+    """
+    Plays any number of sequencers from a single scheduler thread.
+
+    Each sequencer gets its own output bus, an `AudioEngine` that's never started, which this mixes and writes to the
+    bus's sink. Upcoming pulses of every playing sequencer are kept in one heap ordered by frame, so each block only
+    touches the pulses due in it and the buses with something to play. Sequencers that aren't playing cost nothing.
+    Drums are shared too: sequencers asking for the same class and parameters get the same drum.
+
+    With `realtime`, blocks are paced by the clock, otherwise they're produced as fast as possible. Bus sinks shouldn't
+    pace themselves, since they're all written to from the one thread
+    """
+    def __init__(
+        self,
+        block_size: int = BLOCK_SIZE,
+        lookahead_seconds: float = LOOKAHEAD_SECONDS,
+        realtime: bool = True,
+    ):
+        self.block_size = block_size
+        self.lookahead_frames = int(lookahead_seconds * SAMPLE_RATE)
+        self.realtime = realtime
+
+        self.frame = 0
+        self.running = False
+        self._buses = {}
+        # Upcoming pulses as (frame, sequence number, sequencer, play token). A sequencer's entry is stale once its
+        # token no longer matches `_play_tokens`, i.e. it's been stopped since
+        self._pulses = []
+        self._play_tokens = {}
+        # Buses with something to play, by sequencer
+        self._sounding_buses = {}
+        self._tokens = itertools.count()
+        # Guards the state above, and is only held briefly, so controlling sequencers doesn't wait on the audio
+        self._lock = Lock()
+        # Held while a block is scheduled, mixed and written, so a bus's sink isn't closed part way through
+        self._block_lock = Lock()
+        self._drum_futures = {}
+        self._thread = None
+
+    def __repr__(self):
+        return f'SharedEngine {self.stats()}'
+
+    @property
+    def block_duration(self):
+        return self.block_size / SAMPLE_RATE
+
+    def drum_future(self, drum_class: type, **params) -> Future:
+        """
+        Future drum of this class and parameters, synthesised once and shared by every sequencer that asks for it.
+        Shared drums shouldn't have their parameters changed
+        """
+        key = SampleCache.make_key(drum_class, {**drum_class.DEFAULT_PARAMS, **params})
+        with self._lock:
+            if key not in self._drum_futures:
+                self._drum_futures[key] = get_synthesis_executor().submit(drum_class, **params)
+            return self._drum_futures[key]
+
+    def attach(self, sequencer, sink=None) -> AudioEngine:
+        """
+        Give a sequencer an output bus, writing to `sink`, which is discarded by default
+        """
+        bus = AudioEngine(sink if sink is not None else NullSink(realtime=False), self.block_size)
+        bus.sink.open()
+        with self._lock:
+            self._buses[sequencer] = bus
+        return bus
+
+    def detach(self, sequencer) -> None:
+        """
+        Remove a sequencer's bus and close its sink. Does nothing if it's already been detached
+        """
+        self.stop_sequencer(sequencer)
+        with self._block_lock, self._lock:
+            bus = self._buses.pop(sequencer, None)
+            self._sounding_buses.pop(sequencer, None)
+        if bus is not None:
+            bus.sink.close()
+
+    def play_sequencer(self, sequencer) -> None:
+        """
+        Start scheduling a sequencer's pulses, from the first frame that's still far enough ahead
+        """
+        with self._lock:
+            bus = self._buses[sequencer]
+            if sequencer not in self._sounding_buses:
+                bus.frame = self.frame
+                self._sounding_buses[sequencer] = bus
+            token = next(self._tokens)
+            self._play_tokens[sequencer] = token
+            first_frame = self.frame + self.block_size + self.lookahead_frames
+            heapq.heappush(self._pulses, (first_frame, next(self._tokens), sequencer, token))
+
+    def stop_sequencer(self, sequencer) -> None:
+        """
+        Stop scheduling a sequencer's pulses. Hits already scheduled still ring out
+        """
+        with self._lock:
+            self._play_tokens.pop(sequencer, None)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread:
+            self._thread.join()
+
+    def stats(self) -> dict:
+        buses = list(self._buses.values())
+        return {
+            'frame': self.frame,
+            'sequencers': len(buses),
+            'playing_sequencers': len(self._play_tokens),
+            'sounding_buses': len(self._sounding_buses),
+            'shared_drums': len(self._drum_futures),
+            'active_voices': sum(len(bus._voices) for bus in buses),
+            'late_hits': sum(bus.late_hits for bus in buses),
+        }
+
+    def process_block(self) -> None:
+        """
+        Schedule the pulses due by the end of the lookahead window, then mix and write one block on every bus that
+        has something to play.
+
+        The lock is only held to work out what's due and which buses are sounding. Scheduling (which may wait for drums
+        to be synthesised), mixing and writing to sinks happen outside it
+        """
+        horizon = self.frame + self.block_size + self.lookahead_frames
+        with self._block_lock:
+            with self._lock:
+                due_pulses = []
+                while self._pulses and self._pulses[0][0] < horizon:
+                    frame, _, sequencer, token = heapq.heappop(self._pulses)
+                    if self._play_tokens.get(sequencer) == token:
+                        due_pulses.append((frame, sequencer, token))
+
+            for frame, sequencer, token in due_pulses:
+                while frame < horizon:
+                    frame = sequencer.schedule_pulse(frame)
+                with self._lock:
+                    # Unless it's been stopped in the meantime
+                    if self._play_tokens.get(sequencer) == token:
+                        heapq.heappush(self._pulses, (frame, next(self._tokens), sequencer, token))
+
+            with self._lock:
+                sounding_buses = list(self._sounding_buses.items())
+            for sequencer, bus in sounding_buses:
+                bus.sink.write(bus.mix_block())
+                if sequencer.sequencer_gui_interface:
+                    sequencer.push_reached_steps()
+            with self._lock:
+                # Buses of stopped sequencers are dropped once they've rung out
+                for sequencer, bus in sounding_buses:
+                    if sequencer not in self._play_tokens and not bus._voices and not bus._pending:
+                        self._sounding_buses.pop(sequencer, None)
+        self.frame += self.block_size
+
+    def _run(self):
+        start_time = time.perf_counter()
+        start_frame = self.frame
+        while self.running:
+            self.process_block()
+            if self.realtime:
+                delay = start_time + (self.frame - start_frame) / SAMPLE_RATE - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
@@ -0,0 +1,66 @@
+import numpy as np
+
+TELEMETRY_CAPACITY = 4096
+
+
+class PulseTelemetry:
+    """
+    Fixed-size ring buffer of timing measurements for the most recent pulses.
+
+    Recording a pulse is a handful of writes into preallocated arrays, so it can stay on during playback. Times are
+    `time.perf_counter()` values, and summaries are in milliseconds
+    """
+    def __init__(self, n_lanes: int, capacity: int = TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.n_pulses = 0
+        self.scheduled_times = np.zeros(capacity)
+        self.start_times = np.zeros(capacity)
+        self.play_durations = np.zeros(capacity)
+        self.pulse_durations = np.zeros(capacity)
+        # NaN for lanes that didn't trigger on a pulse
+        self.trigger_times = np.full((capacity, n_lanes), np.nan)
+
+    def __repr__(self):
+        return f'PulseTelemetry {self.stats()}'
+
+    def begin_pulse(self, scheduled_time: float, start_time: float, pulse_duration: float) -> np.ndarray:
+        """
+        Returns this pulse's row of trigger times, for the caller to fill in as drums trigger
+        """
+        index = self.n_pulses % self.capacity
+        self.scheduled_times[index] = scheduled_time
+        self.start_times[index] = start_time
+        self.pulse_durations[index] = pulse_duration
+        trigger_times = self.trigger_times[index]
+        trigger_times[:] = np.nan
+        return trigger_times
+
+    def end_pulse(self, end_time: float) -> None:
+        index = self.n_pulses % self.capacity
+        self.play_durations[index] = end_time - self.start_times[index]
+        self.n_pulses += 1
+
+    def stats(self) -> dict:
+        """
+        Summary of the pulses still in the buffer:
+            lateness_p50_ms / lateness_p99_ms: how long after its pulse's scheduled time each drum triggered
+            max_drift_ms: the furthest a pulse started from its scheduled time
+            missed_deadlines: pulses that were still triggering when the next one was due
+            load: mean fraction of each pulse spent triggering drums
+        """
+        n = min(self.n_pulses, self.capacity)
+        if not n:
+            return {'n_pulses': 0}
+        scheduled_times = self.scheduled_times[:n]
+        lateness = (self.trigger_times[:n] - scheduled_times[:, np.newaxis]).ravel()
+        lateness = lateness[~np.isnan(lateness)]
+        lateness_percentiles = np.percentile(lateness, [50, 99]) * 1e3 if len(lateness) else [np.nan, np.nan]
+        pulse_ends = self.start_times[:n] + self.play_durations[:n]
+        return {
+            'n_pulses': n,
+            'lateness_p50_ms': float(lateness_percentiles[0]),
+            'lateness_p99_ms': float(lateness_percentiles[1]),
+            'max_drift_ms': float(np.abs(self.start_times[:n] - scheduled_times).max() * 1e3),
+            'missed_deadlines': int(np.count_nonzero(pulse_ends > scheduled_times + self.pulse_durations[:n])),
+            'load': float(np.mean(self.play_durations[:n] / self.pulse_durations[:n])),
+        }
@@ -0,0 +1,76 @@
+"""
+Checks that the fast paths produce the same audio as the straightforward ones they replace
+"""
+import itertools
+import unittest
+
+import numpy as np
+
+from drums import BassDrum
+from drums import HighHat
+from drums import SnareDrum
+from insert_chain import biquad_coefficients
+from insert_chain import BiquadFilter
+
+BATCH_PARAM_GRIDS = [
+    (BassDrum, {'AMP_DECAY': [0.1, 0.5], 'MAX_PITCH': [100, 300]}),
+    (SnareDrum, {'NOISE_VOLUME_RATIO': [0, 0.3, 1], 'TONE_AMP_DECAY': [0.1, 0.4]}),
+    (HighHat, {'DECAY': [0.01, 0.05], 'REVERB_WET': [0, 0.5]}),
+]
+# As a fraction of full scale
+FLOAT32_TOLERANCE = 1e-3
+BIQUAD_SETTINGS = [('lowpass', 50, 0.707), ('highpass', 5000, 0.5), ('bandpass', 1000, 4), ('lowpass', 15000, 10)]
+BIQUAD_TOLERANCE = 1e-5
+
+
+def biquad_recursion(b, a, x):
+    """
+    Direct form I biquad, one sample at a time
+    """
+    y = np.zeros_like(x)
+    x1 = x2 = y1 = y2 = 0.0
+    for n, x0 in enumerate(x):
+        y[n] = b[0] * x0 + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+        x1, x2, y1, y2 = x0, x1, y[n], y1
+    return y
+
+
+class BatchSynthesisTest(unittest.TestCase):
+    def test_batch_matches_scalar(self):
+        for drum_class, param_grid in BATCH_PARAM_GRIDS:
+            batch = drum_class.generate_batch(param_grid)
+            names = list(param_grid.keys())
+            for row, values in zip(batch, itertools.product(*param_grid.values())):
+                params = dict(zip(names, values))
+                with self.subTest(drum=drum_class.__name__, **params):
+                    sample = drum_class(**params).sample
+                    np.testing.assert_array_equal(row[:len(sample)], sample)
+                    self.assertFalse(row[len(sample):].any())
+
+
+class Float32SynthesisTest(unittest.TestCase):
+    def test_float32_matches_float64(self):
+        for drum_class in (BassDrum, SnareDrum, HighHat):
+            with self.subTest(drum=drum_class.__name__):
+                float64_sample = drum_class().sample
+                # Set on the instance before it synthesises, so the class stays on the float64 path for other tests
+                float32_drum = drum_class.__new__(drum_class)
+                float32_drum.float32_synthesis = True
+                float32_drum.__init__()
+                self.assertEqual(len(float32_drum.sample), len(float64_sample))
+                difference = np.abs(float32_drum.sample.astype(np.int32) - float64_sample).max()
+                self.assertLessEqual(difference, FLOAT32_TOLERANCE * np.iinfo(np.int16).max)
+
+
+class BiquadFilterTest(unittest.TestCase):
+    def test_fft_filter_matches_recursion(self):
+        audio = np.random.default_rng(0).uniform(-1, 1, 5000)
+        for kind, cutoff, q in BIQUAD_SETTINGS:
+            with self.subTest(kind=kind, cutoff=cutoff, q=q):
+                expected = biquad_recursion(*biquad_coefficients(kind, cutoff, q), audio)
+                filtered = BiquadFilter(kind, cutoff, q).process(audio)
+                np.testing.assert_allclose(filtered, expected, atol=BIQUAD_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
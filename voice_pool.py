@@ -0,0 +1,114 @@
+from threading import Lock
+
+import numpy as np
+
+MAX_VOICES = 32
+MAX_VOICES_PER_DRUM = 8
+# How much of a voice, from its current position on, is looked at to judge how loud it is
+LEVEL_WINDOW_SAMPLES = 512
+STEAL_POLICIES = ['oldest', 'quietest']
+
+
+def remaining_level(sample: np.ndarray, position: int) -> int:
+    """
+    Peak absolute level of the next `LEVEL_WINDOW_SAMPLES` of `sample` from `position`
+    """
+    window = sample[position:position + LEVEL_WINDOW_SAMPLES]
+    if not len(window):
+        return 0
+    return max(int(window.max()), -int(window.min()))
+
+
+class VoicePool:
+    """
+    Keeps track of the voices that are sounding, and stops some when a new one starts, to bound how many there are.
+
+    Voices are any objects with `owner` (e.g. the drum that started them), `choke_group`, `is_playing()`, `level()` and
+    `stop()`. When a voice is added:
+    - Voices in the same choke group (e.g. an open hat, when a closed hat starts) are stopped
+    - If its owner already has `max_voices_per_drum` voices, or there are `max_voices` in all, one is stolen to make
+      room, picked by `steal_policy`: the 'oldest', or the 'quietest' from where it's up to
+    """
+    def __init__(
+        self,
+        max_voices: int = MAX_VOICES,
+        max_voices_per_drum: int = MAX_VOICES_PER_DRUM,
+        steal_policy: str = 'oldest',
+    ):
+        if steal_policy not in STEAL_POLICIES:
+            raise ValueError(f'Steal policy {steal_policy} must be one of {STEAL_POLICIES}')
+        self.max_voices = max_voices
+        self.max_voices_per_drum = max_voices_per_drum
+        self.steal_policy = steal_policy
+        # Oldest first
+        self._voices = []
+        self._lock = Lock()
+        self.n_started = 0
+        self.n_stolen = 0
+        self.n_choked = 0
+
+    def __len__(self):
+        return len(self.active_voices())
+
+    def __repr__(self):
+        return f'VoicePool {self.stats()}'
+
+    def add(self, voice) -> None:
+        with self._lock:
+            self._prune()
+            if voice.choke_group is not None:
+                for choked in [other for other in self._voices if other.choke_group == voice.choke_group]:
+                    self._stop(choked)
+                    self.n_choked += 1
+
+            owner_voices = [other for other in self._voices if other.owner is voice.owner]
+            if len(owner_voices) >= self.max_voices_per_drum:
+                self._steal(owner_voices)
+            if len(self._voices) >= self.max_voices:
+                self._steal(self._voices)
+
+            self._voices.append(voice)
+            self.n_started += 1
+
+    def stop(self, owner=None) -> None:
+        """
+        Stop every voice started by `owner`, or every voice if `owner` is None
+        """
+        with self._lock:
+            for voice in list(self._voices):
+                if owner is None or voice.owner is owner:
+                    self._stop(voice)
+
+    def active_voices(self) -> list:
+        with self._lock:
+            self._prune()
+            return list(self._voices)
+
+    def stats(self) -> dict:
+        voices = self.active_voices()
+        active_voices_per_drum = {}
+        for voice in voices:
+            name = voice.owner.__class__.__name__
+            active_voices_per_drum[name] = active_voices_per_drum.get(name, 0) + 1
+        return {
+            'active_voices': len(voices),
+            'active_voices_per_drum': active_voices_per_drum,
+            'started': self.n_started,
+            'stolen': self.n_stolen,
+            'choked': self.n_choked,
+        }
+
+    def _steal(self, candidates):
+        if self.steal_policy == 'oldest':
+            victim = candidates[0]
+        else:
+            victim = min(candidates, key=lambda voice: voice.level())
+        self._stop(victim)
+        self.n_stolen += 1
+
+    def _stop(self, voice):
+        voice.stop()
+        self._voices.remove(voice)
+
+    def _prune(self):
+        self._voices = [voice for voice in self._voices if voice.is_playing()]